@@ -0,0 +1,323 @@
+import csv
+import datetime
+import io
+import logging
+import queue
+import threading
+from collections import Counter, namedtuple
+
+import click
+import dateutil.parser
+from sqlalchemy import event, func, inspect
+
+from models import db, Venue, Artist, Show, VenueDailyShows, ArtistDailyShows, GenreStateDailyShows, RollupState
+import sharding
+
+logger = logging.getLogger(__name__)
+
+DAY = datetime.timedelta(days=1)
+
+
+#----------------------------------------------------------------------------#
+# Daily rollups.
+#----------------------------------------------------------------------------#
+
+# The rollup rows of a day are always rebuilt from that day's shows, never
+# adjusted in place, so rebuilding a day twice or out of order is harmless.
+ROLLUPS = (VenueDailyShows, ArtistDailyShows, GenreStateDailyShows)
+# First key of the per-day advisory locks, the day's ordinal is the second
+ROLLUP_LOCK = 4106
+
+
+def as_day(value):
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def day_runs(days):
+    # Sorted days -> [start, end) ranges of consecutive days
+    runs = []
+    for day in sorted(days):
+        if runs and runs[-1][1] == day:
+            runs[-1][1] = day + DAY
+        else:
+            runs.append([day, day + DAY])
+    return [tuple(run) for run in runs]
+
+
+def lock_days(start, end):
+    # Transaction-level advisory lock on each day in [start, end), so two
+    # workers or a worker and the CLI never delete and insert the same day's
+    # rows at once. Always taken in day order, callers go through their days
+    # in ascending order within a transaction.
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    db.session.execute(
+        'SELECT pg_advisory_xact_lock(:namespace, day) '
+        'FROM generate_series(:first, :last) AS day ORDER BY day',
+        {'namespace': ROLLUP_LOCK, 'first': start.toordinal(), 'last': (end - DAY).toordinal()})
+
+
+def recompute(start, end, chunk_size=5000):
+    '''Rebuilds the rollup rows of the days in [start, end) from Show.
+
+    Runs in the caller's transaction, the caller commits.
+    '''
+    lock_days(start, end)
+    venues, artists, genres = Counter(), Counter(), Counter()
+    rows = db.session.query(Show.start_time, Show.venue_id, Show.artist_id, Venue.state, Artist.genres).\
+           join(Venue, Venue.id == Show.venue_id).join(Artist, Artist.id == Show.artist_id).\
+           filter(Show.start_time >= datetime.datetime.combine(start, datetime.time()),
+                  Show.start_time < datetime.datetime.combine(end, datetime.time())).yield_per(10000)
+    for start_time, venue_id, artist_id, state, artist_genres in rows:
+        day = start_time.date()
+        venues[(venue_id, day)] += 1
+        artists[(artist_id, day)] += 1
+        for genre in set(artist_genres or ()):
+            genres[(state, genre, day)] += 1
+
+    for model in ROLLUPS:
+        model.query.filter(model.day >= start, model.day < end).delete(synchronize_session=False)
+    for model, counts, keys in (
+        (VenueDailyShows, venues, ('venue_id', 'day')),
+        (ArtistDailyShows, artists, ('artist_id', 'day')),
+        (GenreStateDailyShows, genres, ('state', 'genre', 'day')),
+    ):
+        values = [dict(zip(keys, key), shows=shows) for key, shows in counts.items()]
+        for i in range(0, len(values), chunk_size):
+            db.session.execute(model.__table__.insert(), values[i:i + chunk_size])
+    return len(venues) + len(artists) + len(genres)
+
+
+def refresh_days(days):
+    for start, end in day_runs(days):
+        recompute(start, end)
+
+
+def watermark(name):
+    state = RollupState.query.get(name)
+    return state.value if state else 0
+
+
+def set_watermark(name, value):
+    db.session.merge(RollupState(name=name, value=value))
+
+
+def catch_up(trailing_days=45, today=None):
+    # Rebuilds the days of every show added since the last run, plus a
+    # trailing window that picks up deleted and edited shows. Returns the days.
+    today = today or datetime.date.today()
+    last_id = watermark('show_id')
+    days = {today - i * DAY for i in range(trailing_days + 1)}
+    max_id = last_id
+    for show_id, start_time in db.session.query(Show.id, Show.start_time).\
+                               filter(Show.id > last_id).yield_per(10000):
+        days.add(start_time.date())
+        max_id = max(max_id, show_id)
+    for start, end in day_runs(days):
+        recompute(start, end)
+        db.session.commit()
+    set_watermark('show_id', max_id)
+    db.session.commit()
+    return days
+
+
+def rebuild_all():
+    # Every day that has shows, a month at a time
+    first, last, max_id = db.session.query(func.min(Show.start_time), func.max(Show.start_time),
+                                           func.max(Show.id)).one()
+    if first is None:
+        for model in ROLLUPS:
+            model.query.delete(synchronize_session=False)
+        db.session.commit()
+        return 0
+    start = datetime.date(first.year, first.month, 1)
+    months = 0
+    while start <= last.date():
+        end = (start + 32 * DAY).replace(day=1)
+        recompute(start, end)
+        db.session.commit()
+        start = end
+        months += 1
+    set_watermark('show_id', max_id)
+    db.session.commit()
+    return months
+
+
+class RollupWorker(object):
+    '''Single background thread that rebuilds the days touched by show writes.
+
+    Days queued for a shard while it is busy are merged into one pass.
+    '''
+
+    def __init__(self, app=None):
+        self.app = app
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, days):
+        if days:
+            self._enqueue(sharding.current_shard(), set(days), 0)
+
+    def _enqueue(self, shard, days, attempt):
+        self.queue.put((shard, days, attempt))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='rollup-worker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            shard, days, attempt = self.queue.get()
+            by_shard = {shard: (days, attempt)}
+            taken = 1
+            while True:
+                try:
+                    shard, days, attempt = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                merged, merged_attempt = by_shard.get(shard, (set(), 0))
+                by_shard[shard] = (merged | days, max(merged_attempt, attempt))
+                taken += 1
+            for shard, (days, attempt) in by_shard.items():
+                with self.app.app_context(), sharding.use(shard):
+                    try:
+                        refresh_days(days)
+                        db.session.commit()
+                    except Exception:
+                        db.session.rollback()
+                        logger.exception('rollup of %d days on shard %s failed', len(days), shard or 'default')
+                        self._retry(shard, days, attempt)
+                    finally:
+                        db.session.remove()
+            for _ in range(taken):
+                self.queue.task_done()
+
+    def _retry(self, shard, days, attempt):
+        # Failed days are queued again after ROLLUP_RETRY_DELAY seconds,
+        # doubling each time. Past ROLLUP_RETRIES attempts they are left to
+        # the next `flask analytics rollup`.
+        if attempt >= self.app.config.get('ROLLUP_RETRIES', 3):
+            return
+        delay = self.app.config.get('ROLLUP_RETRY_DELAY', 5) * 2 ** attempt
+        timer = threading.Timer(delay, self._enqueue, (shard, days, attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+
+worker = RollupWorker()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_show_days(session, flush_context):
+    pending = session.info.setdefault('rollup_days', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Show):
+            # The old day too when a show was moved
+            history = inspect(obj).attrs.start_time.history
+            pending.update(as_day(value) for value in history.sum() if value is not None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _submit_show_days(session):
+    days = session.info.pop('rollup_days', None)
+    if days and worker.app is not None:
+        worker.submit(days)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_show_days(session):
+    session.info.pop('rollup_days', None)
+
+
+#----------------------------------------------------------------------------#
+# Reports.
+#----------------------------------------------------------------------------#
+
+# Reports only read the rollup tables, never Show itself
+VenueMonth = namedtuple('VenueMonth', ('venue_id', 'venue_name', 'month', 'shows'))
+GenreState = namedtuple('GenreState', ('state', 'genre', 'shows'))
+ArtistBookings = namedtuple('ArtistBookings', ('artist_id', 'artist_name', 'shows', 'days_booked', 'shows_per_month'))
+
+
+def month_of(column):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+
+def venue_shows_per_month(start, end, limit=1000, venue_id=None, state=None):
+    month = month_of(VenueDailyShows.day)
+    query = db.session.query(VenueDailyShows.venue_id, Venue.name, month, func.sum(VenueDailyShows.shows)).\
+            join(Venue, Venue.id == VenueDailyShows.venue_id).\
+            filter(VenueDailyShows.day >= start, VenueDailyShows.day < end, Venue.deleted_at.is_(None))
+    if venue_id is not None:
+        query = query.filter(VenueDailyShows.venue_id == venue_id)
+    if state:
+        query = query.filter(Venue.state == state)
+    query = query.group_by(VenueDailyShows.venue_id, Venue.name, month).\
+            order_by(month, func.sum(VenueDailyShows.shows).desc(), VenueDailyShows.venue_id).limit(limit)
+    return [VenueMonth(*row) for row in query]
+
+
+def genres_by_state(start, end, limit=1000, state=None):
+    total = func.sum(GenreStateDailyShows.shows)
+    query = db.session.query(GenreStateDailyShows.state, GenreStateDailyShows.genre, total).\
+            filter(GenreStateDailyShows.day >= start, GenreStateDailyShows.day < end)
+    if state:
+        query = query.filter(GenreStateDailyShows.state == state)
+    query = query.group_by(GenreStateDailyShows.state, GenreStateDailyShows.genre).\
+            order_by(GenreStateDailyShows.state, total.desc(), GenreStateDailyShows.genre).limit(limit)
+    return [GenreState(*row) for row in query]
+
+
+def artist_bookings(start, end, limit=1000, state=None):
+    months = max(1.0, (end - start).days / 30.44)
+    total = func.sum(ArtistDailyShows.shows)
+    query = db.session.query(ArtistDailyShows.artist_id, Artist.name, total, func.count()).\
+            join(Artist, Artist.id == ArtistDailyShows.artist_id).\
+            filter(ArtistDailyShows.day >= start, ArtistDailyShows.day < end, Artist.deleted_at.is_(None))
+    if state:
+        query = query.filter(Artist.state == state)
+    query = query.group_by(ArtistDailyShows.artist_id, Artist.name).\
+            order_by(total.desc(), ArtistDailyShows.artist_id).limit(limit)
+    return [ArtistBookings(artist_id, name, int(shows), days, round(shows / months, 2))
+            for artist_id, name, shows, days in query]
+
+
+# name -> (query, row type)
+REPORTS = {
+    'venue-shows-per-month': (venue_shows_per_month, VenueMonth),
+    'genres-by-state': (genres_by_state, GenreState),
+    'artist-bookings': (artist_bookings, ArtistBookings),
+}
+
+
+def to_csv(rows, fields):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(fields)
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+def init_app(app):
+    worker.app = app
+
+    @app.cli.group('analytics')
+    def analytics():
+        '''Daily rollups behind the /reports endpoints.'''
+
+    @analytics.command('rollup')
+    @click.option('--trailing-days', default=None, type=int, help='Past days always rebuilt.')
+    @click.option('--full', is_flag=True, help='Rebuild every day that has shows.')
+    def rollup(trailing_days, full):
+        '''Nightly catch-up: rebuild the days changed since the last run.'''
+        if full:
+            click.echo('rebuilt %d months' % rebuild_all())
+            return
+        if trailing_days is None:
+            trailing_days = app.config.get('ROLLUP_TRAILING_DAYS', 45)
+        click.echo('rebuilt %d days' % len(catch_up(trailing_days)))
@@ -4,8 +4,8 @@
 
 import json
 import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify
+from dateutil.relativedelta import relativedelta
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort
 from flask_moment import Moment
 from flask_migrate import Migrate
 import logging
@@ -13,9 +13,29 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 import datetime
-import sys
-
-from models import db, Venue, Artist, Show
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Area, Venue, Artist, Show, Match
+import compression
+import purge
+import partitions
+import entity_cache
+import formatting
+import viewmodels
+from query_budget import query_budget
+import throttling
+import suggest as suggest_index
+import matching
+import idempotency
+import seeding
+import sharding
+import profiling
+import images
+import analytics
+import unit_of_work
+import snapshots
+from throttling import rate_limit, admission_gate
+from unit_of_work import transactional
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -25,27 +45,35 @@ app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
 db.init_app(app)
+sharding.init_app(app)
 migrate = Migrate(app, db)
+compression.init_app(app)
+purge.init_app(app)
+partitions.init_app(app)
+entity_cache.init_app(app)
+throttling.init_app(app)
+matching.init_app(app)
+idempotency.init_app(app)
+seeding.init_app(app)
+profiling.init_app(app)
+images.init_app(app)
+analytics.init_app(app)
+unit_of_work.init_app(app)
+snapshots.init_app(app)
 
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_date(date, format)
-
-# app.jinja_env.filters['datetime'] = format_datetime
+# `datetime` filter, see formatting.py
+formatting.init_app(app)
 
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
 @app.route('/')
+@query_budget(0)
 def index():
   return render_template('pages/home.html')
 
@@ -54,36 +82,21 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@query_budget(1)
+@transactional('read')
 def venues():
-  # TODO: replace with real venues data.
-  #       num_shows should be aggregated based on number of upcoming shows per venue.
-
-  # Query data by city & state, and make reference of city & state so we can append data that has
-  # The same city & state together
-  data = []
-  query_set = Venue.query.order_by(Venue.city, Venue.state).all()
-  ref_city = None
-  ref_state = None
-  for venue in query_set:
-    if venue.state == ref_state and venue.city == ref_city:
-      data[-1]["venues"].append({
-        "id": venue.id,
-        "name": venue.name
-      })
-    else:
-      data.append({
-        "city": venue.city,
-        "state": venue.state,
-        "venues": [{
-          "id": venue.id,
-          "name": venue.name
-        }]
-      })
-      ref_city = venue.city
-      ref_state = venue.state
-  return render_template('pages/venues.html', areas=data)
+  # Walk venues in (area_id, name) index order, the few areas are sorted by city afterwards
+  query_set = db.session.query(Area.id, Area.city, Area.state, Venue.id, Venue.name).\
+              join(Venue, Venue.area_id == Area.id).\
+              filter(Venue.deleted_at.is_(None)).\
+              order_by(Area.id, Venue.name).all()
+  return render_view('pages/venues.html', areas=viewmodels.group_areas(query_set))
 
 @app.route('/venues/search', methods=['POST'])
+@query_budget(1)
+@rate_limit(2, 10)
+@admission_gate
+@transactional('search')
 def search_venues():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for Hop should return "The Musical Hop".
@@ -92,7 +105,7 @@ def search_venues():
   response["count"] = 0
   response['data'] = []
   q = request.form.get('search_term')
-  query_set = Venue.query.\
+  query_set = Venue.active().\
               filter(Venue.name.ilike(f'{q}%') | Venue.name.ilike(f'%{q}') | Venue.name.ilike(f'%{q}%')).all()
 
   for result in query_set:
@@ -103,66 +116,84 @@ def search_venues():
   response['count'] = len(query_set)
   return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
+@app.route('/images/<name>')
+@query_budget(0)
+def image(name):
+  # Content-addressed thumbnails of venue and artist image links, see images.py
+  response = images.send(name)
+  if response is None:
+    abort(404)
+  return response
+
+@app.route('/suggest')
+@query_budget(1)
+@transactional('read')
+def suggest():
+  # Search-as-you-type over venue, artist and city names, served from memory
+  index = suggest_index.ensure_loaded()
+  limit = min(request.args.get('limit', 10, type=int), 50)
+  kinds = set(filter(None, request.args.get('types', '').split(','))) or None
+  endpoints = {'venue': 'show_venue', 'artist': 'show_artist'}
+  suggestions = []
+  for kind, entity_id, label in index.search(request.args.get('q', ''), limit, kinds):
+    if kind in endpoints:
+      url = url_for(endpoints[kind], **{kind + '_id': entity_id})
+    else:
+      city, state = label.rsplit(', ', 1)
+      url = url_for('show_area', state=state, city=city)
+    suggestions.append({"type": kind, "id": entity_id, "name": label, "url": url})
+  return jsonify({"suggestions": suggestions})
+
+def history_window():
+  # Detail pages list only the last SHOW_HISTORY_MONTHS of past shows so the
+  # query is pruned to recent partitions. ?history=<months> widens the window.
+  history = request.args.get('history', app.config['SHOW_HISTORY_MONTHS'], type=int)
+  history = max(history, 1)
+  return history, datetime.datetime.today() - relativedelta(months=history)
+
+def render_view(template, **context):
+  # Pages built from view models are also served as JSON to clients asking for it
+  best = request.accept_mimetypes.best_match(['text/html', 'application/json'])
+  if best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']:
+    return jsonify(viewmodels.as_dict(context))
+  return render_template(template, **context)
+
 @app.route('/venues/<int:venue_id>')
+@query_budget(5)
+@transactional('read')
 def show_venue(venue_id):
   # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-  try:
-    data = Venue.query.get(venue_id)
-    shows = Venue.query.get(venue_id).shows
-    past_shows = [show for show in shows if show.start_time < datetime.datetime.today()]
-    upcoming_shows = [show for show in shows if show.start_time >= datetime.datetime.today()]
-    past_shows = [
-      {
-        "artist_id": show.artist_id,
-        "artist_name": show.artist.name,
-        "artist_image_link": show.artist.image_link,
-        "start_time": show.start_time.strftime('%Y-%m-%d %H:%M:%S')
-      } 
-    for show in past_shows]
-
-    upcoming_shows = [
-      {
-        "artist_id": show.artist_id,
-        "artist_name": show.artist.name,
-        "artist_image_link": show.artist.image_link,
-        "start_time": show.start_time.strftime('%Y-%m-%d %H:%M:%S')
-      } 
-    for show in upcoming_shows]
-    
-    data = {
-      "id": data.id,
-      "name": data.name,
-      "genres": data.genres,
-      "address": data.address,
-      "city": data.city,
-      "state": data.state,
-      "phone": data.phone,
-      "website": data.website,
-      "facebook_link": data.facebook_link,
-      "seeking_talent": data.seeking_talent,
-      "seeking_description": data.seeking_description,
-      "past_shows": past_shows,
-      "upcoming_shows": upcoming_shows,
-      "past_shows_count": len(past_shows),
-      "upcoming_shows_count": len(upcoming_shows)
-    }    
-  except:
-    print(sys.exc_info())
-    return render_template('errors/500.html'), 500
-  if not data:
+  row = Venue.active().with_entities(*viewmodels.venue_columns()).filter_by(id=venue_id).first()
+  if not row:
     return render_template('errors/404.html'), 404
-  return render_template('pages/show_venue.html', venue=data)
+  history, since = history_window()
+  shows = db.session.query(Show.artist_id, Show.start_time).\
+          filter(Show.venue_id == venue_id, Show.start_time >= since).all()
+  matches = matching.recommendations(Match.venue_id, venue_id, app.config['MATCHES_SHOWN']) if row.seeking_talent else []
+  artists = entity_cache.artists.get_many([show.artist_id for show in shows] + [match[0] for match in matches])
+  past_shows, upcoming_shows = viewmodels.split_shows(
+    shows, artists, viewmodels.VenueShow, formatting.DatetimeFormatter())
+  more_history = db.session.query(Show.id).\
+                 filter(Show.venue_id == venue_id, Show.start_time < since).first() is not None
+  data = viewmodels.detail(viewmodels.VenueDetail, row, past_shows, upcoming_shows, history, more_history)
+  return render_view('pages/show_venue.html', venue=data, recommendations=viewmodels.recommended(matches, artists),
+                     history_step=app.config['SHOW_HISTORY_MONTHS'])
 
 #  Create Venue
 #  ----------------------------------------------------------------
 
 @app.route('/venues/create', methods=['GET'])
+@query_budget(0)
 def create_venue_form():
   form = VenueForm()
   return render_template('forms/new_venue.html', form=form)
 
 @app.route('/venues/create', methods=['POST'])
+@query_budget(6)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
+@idempotency.idempotent
 def create_venue_submission():
   # TODO: insert form data as a new Venue record in the db, instead
   # TODO: modify data to be the data object returned from db insertion
@@ -178,19 +209,24 @@ def create_venue_submission():
   phone = request.form['phone']
   genres = request.form.getlist('genres')
   fb_link = request.form['facebook_link']
-  new_venue = Venue(name=name, city=city, state=state, address=address, phone=phone, genres=genres, facebook_link=fb_link)
+  image_link = request.form.get('image_link') or None
+  new_venue = Venue(name=name, city=city, state=state, address=address, phone=phone, genres=genres, facebook_link=fb_link, image_link=image_link)
+  new_venue.area = Area.for_location(city, state)
   form = VenueForm(obj=new_venue)
 
   if form.validate_on_submit():
     try:
+      message = 'Venue ' + new_venue.name + ' was successfully listed!'
       db.session.add(new_venue)
+      idempotency.remember(message)
       db.session.commit()
-      flash('Venue ' + new_venue.name + ' was successfully listed!')
-    except:
+      flash(message)
+      if image_link:
+        # Warm the thumbnail before the first page view asks for it
+        images.fetcher.submit(image_link)
+    except Exception:
       db.session.rollback()
-      flash('An error occurred. Venue ' + new_venue.name + ' could not be listed.')
-    finally:
-      db.session.close()
+      flash(idempotency.replay() or 'An error occurred. Venue ' + new_venue.name + ' could not be listed.')
     return render_template('pages/home.html')
   else:
     for field, fielderrors in form.errors.items():
@@ -199,37 +235,48 @@ def create_venue_submission():
     return redirect(url_for('create_venue_form'))
 
 @app.route('/venues/<venue_id>', methods=['DELETE'])
+@query_budget(3)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
 def delete_venue(venue_id):
-  # TODO: Complete this endpoint for taking a venue_id, and using
-  # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
-  # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
-  # clicking that button delete it from the db then redirect the user to the homepage
+  # Marks the venue deleted and hands its shows to the background purge,
+  # so the request never waits on deleting a busy venue's shows.
+  return jsonify({"message": "Succeed" if soft_delete(Venue, venue_id) else "Failed"})
+
+def soft_delete(model, entity_id):
   error = False
   try:
-    venue_to_delete = Venue.query.get(venue_id)
-    db.session.delete(venue_to_delete)
+    entity = model.active().filter_by(id=entity_id).first()
+    if entity is None:
+      raise LookupError(entity_id)
+    entity.deleted_at = datetime.datetime.utcnow()
     db.session.commit()
-    flash('Venue was successfully Deleted!')
-  except:
+    flash(f'{model.__name__} was successfully Deleted!')
+  except Exception:
     db.session.rollback()
     flash('Something went wrong!')
     error = True
-  finally:
-    db.session.close()
-  if(error):
-    return jsonify({"message": "Failed"})
-  return jsonify({"message": "Succeed"})
+  if not error:
+    purge.worker.submit(model, int(entity_id))
+  return not error
 
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@query_budget(1)
+@transactional('read')
 def artists():
   # TODO: replace with real data returned from querying the database
-  query_set = Artist.query.all()
+  query_set = Artist.active().all()
   data = [ {"id": artist.id, "name": artist.name} for artist in query_set]
   return render_template('pages/artists.html', artists=data)
 
 @app.route('/artists/search', methods=['POST'])
+@query_budget(1)
+@rate_limit(2, 10)
+@admission_gate
+@transactional('search')
 def search_artists():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
@@ -238,7 +285,7 @@ def search_artists():
   response["count"] = 0
   response['data'] = []
   q = request.form.get('search_term')
-  query_set = Artist.query.\
+  query_set = Artist.active().\
               filter(Artist.name.ilike(f'{q}%') | Artist.name.ilike(f'%{q}') | Artist.name.ilike(f'%{q}%')).all()
 
   for result in query_set:
@@ -250,126 +297,111 @@ def search_artists():
   return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/artists/<int:artist_id>')
+@query_budget(5)
+@transactional('read')
 def show_artist(artist_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-  try:
-    data = Artist.query.get(artist_id)
-    shows = Artist.query.get(artist_id).shows
-    past_shows = [show for show in shows if show.start_time < datetime.datetime.today()]
-    upcoming_shows = [show for show in shows if show.start_time >= datetime.datetime.today()]
-    past_shows = [
-      {
-        "venue_id": show.venue_id,
-        "venue_name": show.venue.name,
-        "venue_image_link": show.venue.image_link,
-        "start_time": show.start_time.strftime('%Y-%m-%d %H:%M:%S')
-      } 
-    for show in past_shows]
-
-    upcoming_shows = [
-      {
-        "venue_id": show.venue_id,
-        "venue_name": show.venue.name,
-        "venue_image_link": show.venue.image_link,
-        "venue_time": show.start_time.strftime('%Y-%m-%d %H:%M:%S')
-      } 
-    for show in upcoming_shows]
-    
-    data = {
-      "id": data.id,
-      "name": data.name,
-      "genres": data.genres,
-      "city": data.city,
-      "state": data.state,
-      "phone": data.phone,
-      "website": data.website,
-      "facebook_link": data.facebook_link,
-      "seeking_venue": data.seeking_venue,
-      "seeking_description": data.seeking_description,
-      "past_shows": past_shows,
-      "upcoming_shows": upcoming_shows,
-      "past_shows_count": len(past_shows),
-      "upcoming_shows_count": len(upcoming_shows)
-    } 
-  except:
-    print(sys.exc_info())
-    return render_template('errors/500.html'), 500
-  if not data:
+  # shows the artist page with the given artist_id
+  row = Artist.active().with_entities(*viewmodels.artist_columns()).filter_by(id=artist_id).first()
+  if not row:
     return render_template('errors/404.html'), 404
-  return render_template('pages/show_artist.html', artist=data)
+  history, since = history_window()
+  shows = db.session.query(Show.venue_id, Show.start_time).\
+          filter(Show.artist_id == artist_id, Show.start_time >= since).all()
+  matches = matching.recommendations(Match.artist_id, artist_id, app.config['MATCHES_SHOWN']) if row.seeking_venue else []
+  venues = entity_cache.venues.get_many([show.venue_id for show in shows] + [match[0] for match in matches])
+  past_shows, upcoming_shows = viewmodels.split_shows(
+    shows, venues, viewmodels.ArtistShow, formatting.DatetimeFormatter())
+  more_history = db.session.query(Show.id).\
+                 filter(Show.artist_id == artist_id, Show.start_time < since).first() is not None
+  data = viewmodels.detail(viewmodels.ArtistDetail, row, past_shows, upcoming_shows, history, more_history)
+  return render_view('pages/show_artist.html', artist=data, recommendations=viewmodels.recommended(matches, venues),
+                     history_step=app.config['SHOW_HISTORY_MONTHS'])
+
+@app.route('/artists/<artist_id>', methods=['DELETE'])
+@query_budget(3)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
+def delete_artist(artist_id):
+  return jsonify({"message": "Succeed" if soft_delete(Artist, artist_id) else "Failed"})
 
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
+@query_budget(1)
+@transactional('read')
 def edit_artist(artist_id):
   # TODO: populate form with fields from artist with ID <artist_id>
-  try:
-    artist = Artist.query.get(artist_id)
-  except:
-    return render_template('errors/500.html'), 500
+  artist = Artist.active().filter_by(id=artist_id).first()
   if not artist:
     return render_template('errors/404.html'), 404
   form = ArtistForm(obj=artist)
   return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
+@query_budget(6)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
 def edit_artist_submission(artist_id):
   # TODO: take values from the form submitted, and update existing
   # artist record with ID <artist_id> using the new attributes
-  try:
-    edit_artist = Artist.query.get(artist_id)
-  except:
-    return render_template('errors/500.html'), 500
+  edit_artist = Artist.active().filter_by(id=artist_id).first()
   if not edit_artist:
     return render_template('errors/404.html'), 404
   form = ArtistForm(obj=edit_artist)
   if form.validate_on_submit():
+    # Resolved before the artist is changed, so nothing else is flushed with a new Area
+    area = Area.for_location(form.city.data, form.state.data)
     edit_artist.name = form.name.data
     edit_artist.city = form.city.data
     edit_artist.state = form.state.data
+    edit_artist.area = area
     edit_artist.phone = form.phone.data
     edit_artist.genres = form.genres.data
     edit_artist.facebook_link = form.facebook_link.data
     db.session.commit()
-    return redirect(url_for('show_artist', artist_id=edit_artist.id))
+    return redirect(url_for('show_artist', artist_id=artist_id))
   return render_template('forms/edit_artist.html', form=form, artist=edit_artist)
 
   return redirect(url_for('show_artist', artist_id=artist_id))
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
+@query_budget(1)
+@transactional('read')
 def edit_venue(venue_id):
   # TODO: populate form with values from venue with ID <venue_id>
-  try:
-    venue = Venue.query.get(venue_id)
-  except:
-    return render_template('errors/500.html'), 500
+  venue = Venue.active().filter_by(id=venue_id).first()
   if not venue:
     return render_template('errors/404.html'), 404
   form = VenueForm(obj=venue)
   return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
+@query_budget(6)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
 def edit_venue_submission(venue_id):
   # TODO: take values from the form submitted, and update existing
   # venue record with ID <venue_id> using the new attributes
-  try:
-    edit_venue = Venue.query.get(venue_id)
-  except:
-    return render_template('errors/500.html'), 500
+  edit_venue = Venue.active().filter_by(id=venue_id).first()
   if not edit_venue:
     return render_template('errors/404.html'), 404
   form = VenueForm(obj=edit_venue)
   if form.validate_on_submit():
+    # Resolved before the venue is changed, so nothing else is flushed with a new Area
+    area = Area.for_location(form.city.data, form.state.data)
     edit_venue.name = form.name.data
     edit_venue.city = form.city.data
     edit_venue.state = form.state.data
+    edit_venue.area = area
     edit_venue.address = form.address.data
     edit_venue.phone = form.phone.data
     edit_venue.genres = form.genres.data
     edit_venue.facebook_link = form.facebook_link.data
     db.session.commit()
-    return redirect(url_for('show_venue', venue_id=edit_venue.id))
+    return redirect(url_for('show_venue', venue_id=venue_id))
   return render_template('forms/edit_venue.html', form=form, venue=edit_venue)
   
 
@@ -377,11 +409,17 @@ def edit_venue_submission(venue_id):
 #  ----------------------------------------------------------------
 
 @app.route('/artists/create', methods=['GET'])
+@query_budget(0)
 def create_artist_form():
   form = ArtistForm()
   return render_template('forms/new_artist.html', form=form)
 
 @app.route('/artists/create', methods=['POST'])
+@query_budget(6)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
+@idempotency.idempotent
 def create_artist_submission():
   # called upon submitting the new artist listing form
   # TODO: insert form data as a new Venue record in the db, instead
@@ -395,19 +433,24 @@ def create_artist_submission():
   phone = request.form['phone']
   genres = request.form.getlist('genres')
   fb_link = request.form['facebook_link']
-  new_Artist = Artist(name=name, city=city, state=state, phone=phone, genres=genres, facebook_link=fb_link)
+  image_link = request.form.get('image_link') or None
+  new_Artist = Artist(name=name, city=city, state=state, phone=phone, genres=genres, facebook_link=fb_link, image_link=image_link)
+  new_Artist.area = Area.for_location(city, state)
 
   form = ArtistForm(obj=new_Artist)
   if form.validate_on_submit():
     try:
+      message = 'Artist ' + new_Artist.name + ' was successfully listed!'
       db.session.add(new_Artist)
+      idempotency.remember(message)
       db.session.commit()
-      flash('Artist ' + new_Artist.name + ' was successfully listed!')
-    except:
+      flash(message)
+      if image_link:
+        # Warm the thumbnail before the first page view asks for it
+        images.fetcher.submit(image_link)
+    except Exception:
       db.session.rollback()
-      flash('An error occurred. Venue ' + new_Artist.name + ' could not be listed.')
-    finally:
-      db.session.close()
+      flash(idempotency.replay() or 'An error occurred. Artist ' + new_Artist.name + ' could not be listed.')
     return render_template('pages/home.html')
   else:
     for field, fielderrors in form.errors.items():
@@ -416,32 +459,73 @@ def create_artist_submission():
     return redirect(url_for('create_artist_form'))
 
 
+#  Areas
+#  ----------------------------------------------------------------
+
+@app.route('/areas/<state>/<city>')
+@query_budget(5)
+@transactional('read')
+def show_area(state, city):
+  # Venues and artists of one city, paginated over the (area_id, name) indexes
+  area = Area.query.filter_by(state=state, city=city).first()
+  if not area:
+    return render_template('errors/404.html'), 404
+  page = request.args.get('page', 1, type=int)
+  per_page = min(request.args.get('per_page', app.config['AREA_PAGE_SIZE'], type=int), 100)
+  venues = Venue.active().with_entities(Venue.id, Venue.name).\
+           filter(Venue.area_id == area.id).order_by(Venue.name).\
+           paginate(page, per_page, error_out=False)
+  artists = Artist.active().with_entities(Artist.id, Artist.name).\
+            filter(Artist.area_id == area.id).order_by(Artist.name).\
+            paginate(page, per_page, error_out=False)
+  return render_template('pages/area.html', area=area, venues=venues, artists=artists, page=page)
+
+
 #  Shows
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
+@query_budget(3)
+@transactional('read')
 def shows():
   # displays list of shows at /shows
-  # TODO: replace with real venues data.
-  #       num_shows should be aggregated based on number of upcoming shows per venue.
-  shows = Show.query.all()
-  data = [{
-    "venue_id": show.venue_id,
-    "venue_name": show.venue.name,
-    "artist_id": show.artist_id,
-    "artist_name": show.artist.name,
-    "artist_image_link": show.artist.image_link,
-    "start_time": show.start_time
-  }for show in shows]
-  return render_template('pages/shows.html', shows=data)
+  # Names and images come from the entity cache, so this is one query for the
+  # shows plus at most one per model for entities not cached yet
+  shows = db.session.query(Show.venue_id, Show.artist_id, Show.start_time).all()
+  venues = entity_cache.venues.get_many(show.venue_id for show in shows)
+  artists = entity_cache.artists.get_many(show.artist_id for show in shows)
+  data = []
+  for venue_id, artist_id, start_time in shows:
+    venue = venues.get(venue_id)
+    artist = artists.get(artist_id)
+    if venue is None or venue.deleted or artist is None or artist.deleted:
+      continue
+    data.append(viewmodels.ShowListing(
+      venue_id, venue.name, artist_id, artist.name, artist.image_link, start_time))
+  return render_view('pages/shows.html', shows=formatting.format_shows(data))
 
 @app.route('/shows/create')
+@query_budget(0)
 def create_shows():
   # renders form. do not touch.
   form = ShowForm()
   return render_template('forms/new_show.html', form=form)
 
+def is_duplicate_show(error):
+  # psycopg2 names the violated constraint, the copy of uq_show_venue_artist_start_time
+  # on the partition the row went to. SQLite only lists its columns.
+  diag = getattr(error.orig, 'diag', None)
+  if diag is not None and diag.constraint_name is not None:
+    return diag.constraint_name in ('uq_show_venue_artist_start_time',
+                                    '%s_venue_id_artist_id_start_time_key' % diag.table_name)
+  return 'Show.venue_id, Show.artist_id, Show.start_time' in str(error.orig)
+
 @app.route('/shows/create', methods=['POST'])
+@query_budget(5)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('write')
+@idempotency.idempotent
 def create_show_submission():
   # called to create new shows in the db, upon submitting new show listing form
   # TODO: insert form data as a new Show record in the db, instead
@@ -451,18 +535,60 @@ def create_show_submission():
   try:
     venue_id = request.form['venue_id']
     artist_id = request.form['artist_id']
-    start_time = request.form['start_time']
+    start_time = dateutil.parser.parse(request.form['start_time'])
+    # Before this transaction takes any lock the partition's CREATE could wait on
+    partitions.ensure_partition(start_time)
+    # Both ends must be live, FOR SHARE holds off a soft delete or purge of
+    # either row until the show is committed
+    booked = db.session.query(Venue.id, Artist.id).\
+             filter(Venue.id == venue_id, Venue.deleted_at.is_(None),
+                    Artist.id == artist_id, Artist.deleted_at.is_(None)).\
+             with_for_update(read=True).first()
+    if booked is None:
+      raise LookupError((venue_id, artist_id))
     new_show = Show(venue_id=venue_id, artist_id=artist_id, start_time=start_time)
     db.session.add(new_show)
+    idempotency.remember('Show was successfully listed!')
     db.session.commit()
     flash('Show was successfully listed!')
-  except:
+  except IntegrityError as error:
+    db.session.rollback()
+    if is_duplicate_show(error):
+      flash('This show is already listed.')
+    else:
+      flash(idempotency.replay() or 'An error occurred. Show could not be listed.')
+  except Exception:
     db.session.rollback()
     flash('An error occurred. Show could not be listed.')
-  finally:
-    db.session.close()
   return render_template('pages/home.html')
 
+#  Reports
+#  ----------------------------------------------------------------
+
+@app.route('/reports/<report>')
+@query_budget(2)
+@rate_limit(0.5, 5)
+@admission_gate
+@transactional('report')
+def report(report):
+  # Read from the daily rollups kept by analytics.py, ?from=&to= are dates
+  # (default: the last 12 months), ?format=csv|json
+  if report not in analytics.REPORTS:
+    abort(404)
+  build, row_type = analytics.REPORTS[report]
+  try:
+    end = datetime.date.fromisoformat(request.args['to']) if 'to' in request.args else datetime.date.today() + datetime.timedelta(days=1)
+    start = datetime.date.fromisoformat(request.args['from']) if 'from' in request.args else end - relativedelta(months=12)
+  except ValueError:
+    abort(400)
+  limit = min(request.args.get('limit', app.config['REPORT_MAX_ROWS'], type=int), app.config['REPORT_MAX_ROWS'])
+  rows = build(start, end, limit=limit, state=request.args.get('state') or None)
+  if request.args.get('format') == 'csv':
+    return Response(analytics.to_csv(rows, row_type._fields), mimetype='text/csv', headers={
+      'Content-Disposition': 'attachment; filename=%s_%s_%s.csv' % (report, start, end)})
+  return jsonify(report=report, start=start.isoformat(), end=end.isoformat(),
+                 rows=[row._asdict() for row in rows])
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -0,0 +1,99 @@
+'''Bytes-on-the-wire and CPU cost of compression per page.
+
+Renders the listing templates with synthetic catalogs (no database needed)
+and reports raw, whitespace-trimmed, gzip and brotli sizes plus the time
+spent compressing. Bodies go through CompressionMiddleware as WSGI responses
+of CHUNK_SIZE chunks, the same per-chunk flushing path pages are served on.
+
+    $ python benchmarks/compression_bench.py [catalog_size]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import app
+import compression
+from compression import CompressionMiddleware
+
+
+def synthetic_context(size):
+    shows = [{
+        "venue_id": i % 50,
+        "venue_name": "Venue %d" % (i % 50),
+        "artist_id": i % 200,
+        "artist_name": "Artist %d" % (i % 200),
+        "artist_image_link": "https://images.example.com/artist/%d.jpg" % (i % 200),
+        "start_time": "2020-08-%02d 20:00:00" % (i % 28 + 1),
+    } for i in range(size)]
+    areas = [{
+        "city": "City %d" % c,
+        "state": "CA",
+        "venues": [{"id": c * 10 + v, "name": "Venue %d" % (c * 10 + v)} for v in range(10)],
+    } for c in range(max(1, size // 10))]
+    artists = [{"id": i, "name": "Artist %d" % i} for i in range(size)]
+    return {
+        '/': ('pages/home.html', {}),
+        '/shows': ('pages/shows.html', {'shows': shows}),
+        '/venues': ('pages/venues.html', {'areas': areas}),
+        '/artists': ('pages/artists.html', {'artists': artists}),
+    }
+
+
+def render_all(trim, pages):
+    env = app.jinja_env
+    if trim:
+        env = env.overlay(trim_blocks=True, lstrip_blocks=True,
+                          extensions=[compression.WhitespaceTrimExtension])
+    bodies = {}
+    with app.test_request_context('/'):
+        for route, (template, context) in pages.items():
+            bodies[route] = env.get_template(template).render(**context).encode('utf-8')
+    return bodies
+
+
+# Streamed templates and send_file hand the middleware chunks of about this size
+CHUNK_SIZE = 8192
+
+
+def static_app(body):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                                  ('Content-Length', str(len(body)))])
+        return [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    return app
+
+
+def compressed(body, coding):
+    middleware = CompressionMiddleware(static_app(body))
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': coding}
+    return b''.join(middleware(environ, lambda status, headers, exc_info=None: None))
+
+
+def timed(fn, data, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(data)
+    return len(out), (time.perf_counter() - start) / repeat * 1000
+
+
+def main(size=1000):
+    pages = synthetic_context(size)
+    plain = render_all(False, pages)
+    trimmed = render_all(True, pages)
+    print('catalog size %d' % size)
+    print('%-10s %9s %9s %16s %16s' % ('route', 'raw', 'trimmed', 'gzip-6 (ms)', 'br-4 (ms)'))
+    for route in pages:
+        gz_size, gz_ms = timed(lambda d: compressed(d, 'gzip'), trimmed[route])
+        if compression.brotli is not None:
+            br_size, br_ms = timed(lambda d: compressed(d, 'br'), trimmed[route])
+            br = '%7d %6.2f' % (br_size, br_ms)
+        else:
+            br = 'n/a'
+        print('%-10s %9d %9d %9d %6.2f %16s' % (
+            route, len(plain[route]), len(trimmed[route]), gz_size, gz_ms, br))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,52 @@
+'''Show time formatting: the old parse-and-format filter against formatting.py.
+
+    $ python benchmarks/datetime_bench.py [rows]
+'''
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import babel.dates
+import dateutil.parser
+
+from app import app
+import formatting
+import viewmodels
+
+
+def legacy_format(value, format='medium'):
+    # The filter app.py used to define. It called format_date, which drops the
+    # time and fails on the h:mma fields, so format_datetime stands in for it.
+    date = dateutil.parser.parse(value)
+    if format == 'full':
+        format = "EEEE MMMM, d, y 'at' h:mma"
+    elif format == 'medium':
+        format = "EE MM, dd, y h:mma"
+    return babel.dates.format_datetime(date, format, locale='en_US')
+
+
+def timed(label, fn, rows):
+    start = time.perf_counter()
+    fn(rows)
+    elapsed = time.perf_counter() - start
+    print('%-34s %8.1f ms %8.2f us/row' % (label, elapsed * 1000, elapsed / len(rows) * 1e6))
+
+
+def main(count=20000):
+    base = datetime.datetime(2020, 1, 1, 20, 0)
+    rows = [base + datetime.timedelta(hours=i) for i in range(count)]
+    strings = [str(row) for row in rows]
+    print('%d show times' % count)
+    with app.test_request_context('/'):
+        timed('legacy parse + format', lambda r: [legacy_format(v) for v in r], strings)
+        timed('format_datetime per value', lambda r: [formatting.format_datetime(v) for v in r], rows)
+        timed('DatetimeFormatter batch', lambda r: list(map(formatting.DatetimeFormatter(), r)), rows)
+        shows = [viewmodels.VenueShow(1, 'Artist', None, row) for row in rows]
+        timed('format_shows', formatting.format_shows, shows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,52 @@
+'''Compute time of the venue/artist matching batch job on synthetic data.
+
+    $ python benchmarks/matching_bench.py [venues] [artists]
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import matching
+
+
+def synthetic(count, areas, rng):
+    genres = list(matching.GENRE_BITS)
+    return [matching.Candidate(i, rng.randrange(areas),
+                               matching.genre_mask(rng.sample(genres, rng.randint(1, 4))))
+            for i in range(count)]
+
+
+def main(venue_count=100000, artist_count=100000, top_n=10):
+    rng = random.Random(42)
+    venues = synthetic(venue_count, 500, rng)
+    artists = synthetic(artist_count, 500, rng)
+    bookings = {(rng.randrange(venue_count), rng.randrange(artist_count)): rng.randint(1, 20)
+                for _ in range(venue_count)}
+    start = time.perf_counter()
+    matches = matching.compute_matches(venues, artists, bookings, top_n)
+    elapsed = time.perf_counter() - start
+    print('%d venues x %d artists, top %d (numpy: %s): %d matches in %.2fs (%.1f us/entity)' % (
+        venue_count, artist_count, top_n, matching.numpy is not None, len(matches), elapsed,
+        elapsed / (venue_count + artist_count) * 1e6))
+
+    # Check against exhaustive scoring on a sample
+    side = matching._Side(artists)
+    by_venue = {}
+    for (venue_id, artist_id), count in bookings.items():
+        by_venue.setdefault(venue_id, {})[artist_id] = count
+    misses = 0
+    for venue in rng.sample(venues, 20):
+        fast = [score for score, _ in matching.top_matches(venue, side, by_venue.get(venue.id, {}), top_n)]
+        scores = sorted((
+            matching.WEIGHTS['genres'] * matching.jaccard(venue.mask, artist.mask)
+            + (matching.WEIGHTS['area'] if artist.area_id == venue.area_id else 0)
+            for artist in artists), reverse=True)[:top_n]
+        misses += sum(1 for a, b in zip(fast, scores) if a + 1e-9 < b)
+    print('sampled entities whose top scores fall below exhaustive scoring: %d/%d' % (misses, 20 * top_n))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
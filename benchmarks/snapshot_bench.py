@@ -0,0 +1,72 @@
+'''Throughput of the public pages served dynamically and from snapshots.
+
+Needs a seeded database (see `flask seed generate`). Renders the sampled
+pages once, then requests them in turn through the test client with publish
+mode off and on, reporting requests per second and queries per request.
+
+    $ DATABASE_URL=sqlite:////tmp/fyyur.db python benchmarks/snapshot_bench.py [pages] [rounds]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import app
+from models import Venue, Artist
+from query_budget import QueryBudget
+import images
+import snapshots
+
+
+def sample_paths(count):
+    with app.app_context():
+        venue_ids = [row.id for row in Venue.active().with_entities(Venue.id).limit(count)]
+        artist_ids = [row.id for row in Artist.active().with_entities(Artist.id).limit(count)]
+    return (['/', '/venues', '/artists'] +
+            [snapshots.venue_path(venue_id) for venue_id in venue_ids] +
+            [snapshots.artist_path(artist_id) for artist_id in artist_ids])
+
+
+def run(label, client, paths, rounds):
+    budget = QueryBudget(float('inf'), label)
+    requests = 0
+    start = time.perf_counter()
+    with budget:
+        for _ in range(rounds):
+            for path in paths:
+                response = client.get(path)
+                assert response.status_code == 200, (path, response.status_code)
+                requests += 1
+    elapsed = time.perf_counter() - start
+    print('%-10s %6d requests %8.1f req/s %6.2f ms/req %6.2f queries/req' % (
+        label, requests, requests / elapsed, elapsed * 1000 / requests, budget.count / requests))
+
+
+def main(pages=50, rounds=5):
+    root = tempfile.mkdtemp(prefix='snapshots-')
+    snapshots.store.root = root
+    app.config.update(QUERY_BUDGET_ENABLED=False, SNAPSHOT_MAX_AGE=None)
+    try:
+        paths = sample_paths(pages)
+        with app.app_context():
+            waiting = [path for path in paths if snapshots.render(app, None, path)[1]]
+        # Pages showing placeholders are only stored once their images are fetched
+        images.fetcher.queue.join()
+        with app.app_context():
+            for path in waiting:
+                snapshots.render(app, None, path)
+        client = app.test_client()
+        print('%d pages x %d rounds' % (len(paths), rounds))
+        app.config['SNAPSHOTS_ENABLED'] = False
+        run('dynamic', client, paths, rounds)
+        app.config['SNAPSHOTS_ENABLED'] = True
+        run('snapshot', client, paths, rounds)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
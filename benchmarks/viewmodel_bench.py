@@ -0,0 +1,66 @@
+'''Memory and allocation cost of a large /shows listing.
+
+Compares the old approach (an ORM instance plus a dict per row) with view
+models built straight from projected rows.
+
+    $ python benchmarks/viewmodel_bench.py [rows]
+'''
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from models import Show
+import viewmodels
+
+
+def rows(count):
+    base = datetime.datetime(2020, 1, 1, 20, 0)
+    return [(i % 500, 'Venue %d' % (i % 500), i % 2000, 'Artist %d' % (i % 2000),
+             'https://images.example.com/%d.jpg' % (i % 2000), base + datetime.timedelta(hours=i))
+            for i in range(count)]
+
+
+def orm_and_dicts(data):
+    shows = [Show(venue_id=venue_id, artist_id=artist_id, start_time=start_time)
+             for venue_id, _, artist_id, _, _, start_time in data]
+    return [{
+        "venue_id": show.venue_id,
+        "venue_name": venue_name,
+        "artist_id": show.artist_id,
+        "artist_name": artist_name,
+        "artist_image_link": image_link,
+        "start_time": show.start_time
+    } for show, (_, venue_name, _, artist_name, image_link, _) in zip(shows, data)], shows
+
+
+def view_models(data):
+    return [viewmodels.ShowListing(*row) for row in data]
+
+
+def measure(label, fn, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(data)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    print('%-22s %8.1f ms %9.1f KiB held %9.1f KiB peak %9d blocks' % (
+        label, elapsed * 1000, current / 1024, peak / 1024, blocks))
+    return result
+
+
+def main(count=50000):
+    data = rows(count)
+    print('%d shows' % count)
+    measure('ORM instance + dict', orm_and_dicts, data)
+    measure('ShowListing', view_models, data)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
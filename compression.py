@@ -0,0 +1,217 @@
+import re
+import zlib
+
+from jinja2.ext import Extension
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+#----------------------------------------------------------------------------#
+# Response compression.
+#----------------------------------------------------------------------------#
+
+DEFAULT_MIMETYPES = (
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+)
+
+
+def parse_accept_encoding(header):
+    # Returns {coding: q} for the codings the client did not refuse with q=0
+    codings = {}
+    for part in (header or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding.strip().lower()] = q
+    return {coding: q for coding, q in codings.items() if q > 0}
+
+
+class _GzipEncoder(object):
+    name = 'gzip'
+
+    def __init__(self, level):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder(object):
+    name = 'br'
+
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data) + self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class CompressionMiddleware(object):
+    '''WSGI middleware that gzip/brotli encodes responses.
+
+    Bodies are buffered only until ``min_size`` bytes have been seen, after
+    that every chunk is compressed and flushed as it arrives so streamed
+    responses keep streaming. Responses that end below the threshold are
+    sent untouched.
+    '''
+
+    def __init__(self, app, min_size=500, level=6, br_level=4,
+                 mimetypes=DEFAULT_MIMETYPES, brotli_enabled=True):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.br_level = br_level
+        self.mimetypes = frozenset(mimetypes)
+        self.brotli_enabled = brotli_enabled and brotli is not None
+
+    def choose_encoder(self, environ):
+        accepted = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if self.brotli_enabled and 'br' in accepted:
+            return lambda: _BrotliEncoder(self.br_level)
+        if 'gzip' in accepted or '*' in accepted:
+            return lambda: _GzipEncoder(self.level)
+        return None
+
+    def __call__(self, environ, start_response):
+        make_encoder = self.choose_encoder(environ)
+        if make_encoder is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        state = {}
+        written = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            state['status'] = status
+            state['headers'] = headers
+            state['exc_info'] = exc_info
+            return written.append
+
+        app_iter = self.app(environ, capture_start_response)
+        if not self.is_compressible(state['status'], state['headers']):
+            start_response(state['status'], state['headers'], state['exc_info'])
+            return self._passthrough(written, app_iter)
+        return self._compress(written, app_iter, make_encoder, state, start_response)
+
+    def is_compressible(self, status, headers):
+        code = status.split(' ', 1)[0]
+        if code in ('204', '206', '304') or code.startswith('1'):
+            return False
+        mimetype = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                mimetype = value.split(';', 1)[0].strip().lower()
+            if name == 'content-length' and value.isdigit() and int(value) < self.min_size:
+                return False
+            if name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+        return mimetype in self.mimetypes
+
+    def _passthrough(self, written, app_iter):
+        try:
+            for chunk in written:
+                yield chunk
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _compress(self, written, app_iter, make_encoder, state, start_response):
+        buffered = []
+        size = 0
+        encoder = None
+        try:
+            for source in (written, app_iter):
+                for chunk in source:
+                    if not chunk:
+                        continue
+                    if encoder is None:
+                        buffered.append(chunk)
+                        size += len(chunk)
+                        if size < self.min_size:
+                            continue
+                        encoder = make_encoder()
+                        self._start(start_response, state, encoder.name)
+                        chunk = b''.join(buffered)
+                        buffered = None
+                    data = encoder.compress(chunk)
+                    if data:
+                        yield data
+            if encoder is None:
+                start_response(state['status'], state['headers'], state['exc_info'])
+                if buffered:
+                    yield b''.join(buffered)
+            else:
+                yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _start(self, start_response, state, coding):
+        headers = [(name, value) for name, value in state['headers']
+                   if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', coding))
+        for i, (name, value) in enumerate(headers):
+            if name.lower() == 'vary':
+                if 'accept-encoding' not in value.lower():
+                    headers[i] = (name, value + ', Accept-Encoding')
+                break
+        else:
+            headers.append(('Vary', 'Accept-Encoding'))
+        start_response(state['status'], headers, state['exc_info'])
+
+
+#----------------------------------------------------------------------------#
+# Template whitespace trimming.
+#----------------------------------------------------------------------------#
+
+_leading_whitespace = re.compile(r'^[ \t]+', re.MULTILINE)
+_blank_lines = re.compile(r'\n{2,}')
+
+
+class WhitespaceTrimExtension(Extension):
+    # Strips template indentation and blank lines from the template source
+    # once at compile time, so rendering does no extra work per request.
+
+    def preprocess(self, source, name, filename=None):
+        source = _leading_whitespace.sub('', source)
+        return _blank_lines.sub('\n', source)
+
+
+def init_app(app):
+    config = app.config
+    if config.get('TEMPLATE_WHITESPACE_TRIM'):
+        app.jinja_env.trim_blocks = True
+        app.jinja_env.lstrip_blocks = True
+        app.jinja_env.add_extension(WhitespaceTrimExtension)
+    if config.get('COMPRESS_ENABLED', True):
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app,
+            min_size=config.get('COMPRESS_MIN_SIZE', 500),
+            level=config.get('COMPRESS_LEVEL', 6),
+            br_level=config.get('COMPRESS_BR_LEVEL', 4),
+            mimetypes=config.get('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES),
+            brotli_enabled=config.get('COMPRESS_BROTLI', True),
+        )
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from models import db, Venue, Artist
+import sharding
+
+
+#----------------------------------------------------------------------------#
+# Per-process cache of the venue/artist fields used by show listings.
+#----------------------------------------------------------------------------#
+
+class EntitySummary(object):
+    __slots__ = ('id', 'name', 'image_link', 'deleted')
+
+    def __init__(self, id, name, image_link, deleted):
+        self.id = id
+        self.name = name
+        self.image_link = image_link
+        self.deleted = deleted
+
+
+class EntityCache(object):
+    '''Bounded LRU of EntitySummary records for one model.
+
+    Misses are loaded together with a single ``WHERE id IN (...)`` query.
+    Every invalidation bumps a generation counter, and a batch that was
+    loaded while the generation moved on is returned but not stored, so a
+    read racing an edit cannot put stale data back in the cache. Entries are
+    keyed by (shard, id), shards number their rows independently.
+
+    Invalidation only reaches this process. Entries expire ``ttl`` seconds
+    after they were loaded, which bounds how long an edit made by another
+    worker can go unseen here.
+    '''
+
+    def __init__(self, model, maxsize=10000, ttl=60):
+        self.model = model
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, ids):
+        shard = sharding.current_shard()
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for entity_id in set(ids):
+                # (expires at, summary)
+                entry = self._entries.get((shard, entity_id))
+                if entry is None or entry[0] <= now:
+                    missing.append(entity_id)
+                else:
+                    self._entries.move_to_end((shard, entity_id))
+                    found[entity_id] = entry[1]
+            generation = self._generation
+        if not missing:
+            return found
+
+        model = self.model
+        rows = db.session.query(model.id, model.name, model.image_link, model.deleted_at).\
+               filter(model.id.in_(missing))
+        loaded = [EntitySummary(row.id, row.name, row.image_link, row.deleted_at is not None)
+                  for row in rows]
+        expires = now + self.ttl if self.ttl else float('inf')
+        with self._lock:
+            if generation == self._generation:
+                for summary in loaded:
+                    self._entries[(shard, summary.id)] = (expires, summary)
+                    self._entries.move_to_end((shard, summary.id))
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        for summary in loaded:
+            found[summary.id] = summary
+        return found
+
+    def invalidate(self, ids, shard=None):
+        with self._lock:
+            self._generation += 1
+            for entity_id in ids:
+                self._entries.pop((shard, entity_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+venues = EntityCache(Venue)
+artists = EntityCache(Artist)
+_caches = {Venue: venues, Artist: artists}
+
+
+#----------------------------------------------------------------------------#
+# Invalidation.
+#----------------------------------------------------------------------------#
+
+# Ids changed in a flush are collected on the session and dropped from the
+# cache once the transaction commits.
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault('entity_cache_pending', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if type(obj) in _caches and obj.id is not None:
+            pending.add((type(obj), obj.id))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_committed(session):
+    pending = session.info.pop('entity_cache_pending', None)
+    if not pending:
+        return
+    for model, cache in _caches.items():
+        ids = [entity_id for changed, entity_id in pending if changed is model]
+        if ids:
+            cache.invalidate(ids, sharding.current_shard())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('entity_cache_pending', None)
+
+
+def init_app(app):
+    size = app.config.get('ENTITY_CACHE_SIZE', 10000)
+    ttl = app.config.get('ENTITY_CACHE_TTL', 60)
+    for cache in (venues, artists):
+        cache.maxsize = size
+        cache.ttl = ttl
@@ -1,13 +1,86 @@
+import shlex
+
 from fabric.api import local, settings, abort
 from fabric.contrib.console import confirm
 
 # prepare for deployment
 
 
+# Seeded SQLite stand-in. Every view with a query budget is requested (GET and
+# POST), with TESTING on so an overrun raises, and SQLALCHEMY_RAISELOAD=1 /
+# QUERY_BUDGET_RAISE=1 so lazy loads and overruns fail the run instead of logging.
+TEST_DATABASE = "sqlite:////tmp/fyyur-test.db"
+SMOKE_CHECK = """\
+import re
+import app
+from models import Area
+flask_app = app.app
+flask_app.config.update(TESTING=True, QUERY_BUDGET_ENABLED=True, RATELIMIT_ENABLED=False)
+client = flask_app.test_client()
+with flask_app.app_context():
+    area = Area.query.first()
+token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', client.get('/venues/create').get_data(as_text=True)).group(1)
+venue = dict(csrf_token=token, name='Smoke Venue', city=area.city, state=area.state, address='1 Main St', phone='555-555-5555', genres='Jazz', facebook_link='https://www.facebook.com/smoke')
+artist = dict(venue, name='Smoke Artist')
+requests = [
+    ('GET', '/', None), ('GET', '/venues', None), ('GET', '/artists', None), ('GET', '/shows', None),
+    ('GET', '/venues/1', None), ('GET', '/artists/1', None), ('GET', '/venues/1/edit', None), ('GET', '/artists/1/edit', None),
+    ('GET', '/venues/create', None), ('GET', '/artists/create', None), ('GET', '/shows/create', None),
+    ('GET', '/suggest?q=a', None), ('GET', '/areas/%s/%s' % (area.state, area.city), None), ('GET', '/images/missing', None),
+    ('GET', '/reports/venue-shows-per-month', None),
+    ('POST', '/venues/search', {'search_term': 'a'}), ('POST', '/artists/search', {'search_term': 'a'}),
+    ('POST', '/venues/create', venue), ('POST', '/artists/create', artist),
+    ('POST', '/venues/1/edit', venue), ('POST', '/artists/1/edit', artist),
+    ('POST', '/shows/create', {'csrf_token': token, 'venue_id': 2, 'artist_id': 2, 'start_time': '2030-01-01 20:00:00'}),
+    ('DELETE', '/venues/3', None), ('DELETE', '/artists/3', None),
+]
+adapter = flask_app.url_map.bind('localhost')
+covered = set()
+for method, url, data in requests:
+    response = client.open(url.replace(' ', '%20'), method=method, data=data)
+    assert response.status_code in (200, 302, 404), (method, url, response.status_code)
+    covered.add(adapter.match(url.split('?')[0], method)[0])
+budgeted = set(endpoint for endpoint, view in flask_app.view_functions.items() if hasattr(view, 'query_budget'))
+assert budgeted <= covered, budgeted - covered
+"""
+# An image link is fetched from a local HTTP stand-in (IMAGE_ALLOW_PRIVATE_HOSTS),
+# stored and served as a thumbnail, and refused once private hosts are not allowed.
+IMAGE_CHECK = """\
+import base64, functools, http.server, os, tempfile, threading
+import app, images
+flask_app = app.app
+root = tempfile.mkdtemp()
+with open(os.path.join(root, 'a.png'), 'wb') as f:
+    f.write(base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='))
+server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(http.server.SimpleHTTPRequestHandler, directory=root))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://127.0.0.1:%d/a.png' % server.server_port
+images.store.root = os.path.join(root, 'store')
+flask_app.config.update(IMAGE_PROXY_ENABLED=True, IMAGE_ALLOW_PRIVATE_HOSTS=True)
+name = images.fetcher.process(url)
+assert name and images.store.resolve(url) == name, name
+with flask_app.test_request_context('/'):
+    assert images.thumbnail_url(url) == '/images/' + name
+response = flask_app.test_client().get('/images/' + name)
+assert response.status_code == 200 and response.mimetype.startswith('image/'), response.status
+try:
+    images.fetch(url)
+except images.FetchError:
+    pass
+else:
+    raise AssertionError('fetched from a private host')
+server.shutdown()
+"""
+
+
 def test():
     with settings(warn_only=True):
         result = local(
-            "python test_tasks.py -v && python test_users.py -v", capture=True
+            "rm -f /tmp/fyyur-test.db && "
+            "export DATABASE_URL={} FLASK_APP=app.py SQLALCHEMY_RAISELOAD=1 QUERY_BUDGET_RAISE=1 && "
+            "flask seed generate --size small && "
+            "python -c {} && python -c {}".format(
+                TEST_DATABASE, shlex.quote(SMOKE_CHECK), shlex.quote(IMAGE_CHECK)), capture=True
         )
     if result.failed and not confirm("Tests failed. Continue?"):
         abort("Aborted at user request.")
@@ -38,6 +111,12 @@ def heroku():
     local("git push heroku master")
 
 
+def heroku_partitions():
+    # Show partitions for the next SHOW_PARTITION_MONTHS_AHEAD months, so
+    # listing a show rarely has to create one
+    local("heroku run flask partitions ensure")
+
+
 def heroku_test():
     local(
         "heroku run python test_tasks.py -v && heroku run python test_users.py -v"
@@ -49,6 +128,7 @@ def deploy():
     test()
     commit()
     heroku()
+    heroku_partitions()
     heroku_test()
 
 # rollback
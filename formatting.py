@@ -0,0 +1,110 @@
+import datetime
+from functools import lru_cache
+
+import dateutil.parser
+from babel import Locale, UnknownLocaleError
+from babel.dates import get_timezone, parse_pattern
+from flask import current_app, g, has_request_context, request
+
+
+#----------------------------------------------------------------------------#
+# Date formatting.
+#----------------------------------------------------------------------------#
+
+PATTERNS = {
+    'full': "EEEE MMMM, d, y 'at' h:mma",
+    'medium': "EE MM, dd, y h:mma",
+}
+
+
+@lru_cache(maxsize=256)
+def get_pattern(format):
+    # Parsing a babel pattern is the expensive part of formatting, do it once
+    return parse_pattern(PATTERNS.get(format, format))
+
+
+@lru_cache(maxsize=64)
+def get_locale(identifier):
+    return Locale.parse(identifier)
+
+
+@lru_cache(maxsize=64)
+def get_tz(name):
+    return get_timezone(name)
+
+
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    # Only strings still go through dateutil
+    return dateutil.parser.parse(value)
+
+
+def user_preferences():
+    # (locale, timezone name) for the current request, resolved once per request
+    # from the "locale"/"tz" cookies, Accept-Language and the config defaults.
+    config = current_app.config
+    default = (config.get('DEFAULT_LOCALE', 'en_US'), config.get('DEFAULT_TIMEZONE', 'UTC'))
+    if not has_request_context():
+        return default
+    preferences = getattr(g, 'datetime_preferences', None)
+    if preferences is None:
+        supported = config.get('SUPPORTED_LOCALES', [default[0]])
+        locale = request.cookies.get('locale')
+        if locale not in supported:
+            locale = request.accept_languages.best_match(supported) or default[0]
+        tz = request.cookies.get('tz') or default[1]
+        try:
+            get_tz(tz)
+        except LookupError:
+            tz = default[1]
+        preferences = g.datetime_preferences = (locale, tz)
+    return preferences
+
+
+class DatetimeFormatter(object):
+    '''Formats many datetimes with one resolved pattern, locale and timezone.
+
+    Naive values are taken to be in the DEFAULT_TIMEZONE the database stores
+    and are converted to the viewer's timezone.
+    '''
+
+    def __init__(self, format='medium', locale=None, tz=None):
+        if locale is None or tz is None:
+            user_locale, user_tz = user_preferences()
+            locale = locale or user_locale
+            tz = tz or user_tz
+        try:
+            self.locale = get_locale(locale)
+        except (UnknownLocaleError, ValueError):
+            self.locale = get_locale(current_app.config.get('DEFAULT_LOCALE', 'en_US'))
+        self.pattern = get_pattern(format)
+        self.source_tz = get_tz(current_app.config.get('DEFAULT_TIMEZONE', 'UTC'))
+        self.tz = get_tz(tz)
+
+    def __call__(self, value):
+        if value is None or value == '':
+            return ''
+        value = to_datetime(value)
+        if value.tzinfo is None:
+            value = self.source_tz.localize(value)
+        if self.tz is not self.source_tz:
+            value = self.tz.normalize(value.astimezone(self.tz))
+        return self.pattern.apply(value, self.locale)
+
+
+def format_datetime(value, format='medium', locale=None, tz=None):
+    return DatetimeFormatter(format, locale, tz)(value)
+
+
+def format_shows(shows, format='medium', key='start_time'):
+    # Returns the show view models with `key` formatted, resolving the
+    # pattern, locale and timezone once for the whole list
+    formatter = DatetimeFormatter(format)
+    return [show._replace(**{key: formatter(getattr(show, key))}) for show in shows]
+
+
+def init_app(app):
+    app.jinja_env.filters['datetime'] = format_datetime
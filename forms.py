@@ -1,7 +1,8 @@
 from datetime import datetime
+import uuid
 from flask_wtf import Form
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField
-from wtforms.validators import DataRequired, AnyOf, URL, ValidationError
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, HiddenField
+from wtforms.validators import DataRequired, AnyOf, URL, Optional, ValidationError
 
 state_values = [
     'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT','DE', 'DC', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN',
@@ -15,7 +16,14 @@ geners_values = [
     'Instrumental', 'Jazz', 'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae', 'Rock n Roll', 'Soul', 'Other'
 ]
 
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
 class ShowForm(Form):
+    # Sent back with the submission so retries of the same form are recognised
+    idempotency_key = HiddenField(
+        'idempotency_key', default=new_idempotency_key
+    )
     artist_id = StringField(
         'artist_id'
     )
@@ -29,6 +37,9 @@ class ShowForm(Form):
     )
 
 class VenueForm(Form):
+    idempotency_key = HiddenField(
+        'idempotency_key', default=new_idempotency_key
+    )
     name = StringField(
         'name', validators=[DataRequired()]
     )
@@ -100,7 +111,7 @@ class VenueForm(Form):
         'phone', validators=[DataRequired()]
     )
     image_link = StringField(
-        'image_link'
+        'image_link', validators=[Optional(), URL()]
     )
     genres = SelectMultipleField(
         # TODO implement enum restriction
@@ -166,10 +177,18 @@ class VenueForm(Form):
     def validate_facebook_link(form, field):
         if 'fb' not in field.data and 'facebook' not in field.data:
             raise ValidationError('It must be a facebook link')
+
+    # Image links are fetched by the thumbnailer, which only speaks http(s)
+    def validate_image_link(form, field):
+        if not field.data.startswith(('http://', 'https://')):
+            raise ValidationError('Image link must be an http(s) URL')
     
 
 
 class ArtistForm(Form):
+    idempotency_key = HiddenField(
+        'idempotency_key', default=new_idempotency_key
+    )
     name = StringField(
         'name', validators=[DataRequired()]
     )
@@ -237,7 +256,7 @@ class ArtistForm(Form):
         'phone', validators=[DataRequired()]
     )
     image_link = StringField(
-        'image_link'
+        'image_link', validators=[Optional(), URL()]
     )
     genres = SelectMultipleField(
         # TODO implement enum restriction
@@ -305,4 +324,9 @@ class ArtistForm(Form):
         if 'fb' not in field.data and 'facebook' not in field.data:
             raise ValidationError('It must be a facebook link')
 
+    # Image links are fetched by the thumbnailer, which only speaks http(s)
+    def validate_image_link(form, field):
+        if not field.data.startswith(('http://', 'https://')):
+            raise ValidationError('Image link must be an http(s) URL')
+
 # TODO IMPLEMENT NEW ARTIST FORM AND NEW SHOW FORM
@@ -0,0 +1,66 @@
+import datetime
+import functools
+
+import click
+from flask import current_app, flash, g, render_template, request
+
+from models import db, IdempotencyKey
+
+
+#----------------------------------------------------------------------------#
+# Idempotent create submissions.
+#----------------------------------------------------------------------------#
+
+def request_key():
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    return key[:64] if key else None
+
+
+def lookup(key):
+    if not key:
+        return None
+    ttl = datetime.timedelta(seconds=current_app.config.get('IDEMPOTENCY_TTL', 86400))
+    row = db.session.query(IdempotencyKey.message).\
+          filter(IdempotencyKey.key == key, IdempotencyKey.endpoint == request.endpoint,
+                 IdempotencyKey.created_at >= datetime.datetime.utcnow() - ttl).first()
+    return row.message if row else None
+
+
+def remember(message):
+    # Adds the key to the view's transaction, so it commits with the new row or not at all
+    key = g.get('idempotency_key')
+    if key:
+        db.session.add(IdempotencyKey(key=key, endpoint=request.endpoint, message=message))
+
+
+def replay():
+    # After a failed commit: the message of a concurrent submission that
+    # committed the same key first, if there was one
+    return lookup(g.get('idempotency_key'))
+
+
+def idempotent(view):
+    # A submission whose key was already committed gets the original outcome
+    # back without writing anything
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = g.idempotency_key = request_key()
+        message = lookup(key)
+        if message is not None:
+            flash(message)
+            return render_template('pages/home.html')
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+
+    @app.cli.command('purge-idempotency-keys')
+    def purge_idempotency_keys():
+        '''Delete idempotency keys older than IDEMPOTENCY_TTL.'''
+        ttl = datetime.timedelta(seconds=app.config.get('IDEMPOTENCY_TTL', 86400))
+        removed = IdempotencyKey.query.\
+                  filter(IdempotencyKey.created_at < datetime.datetime.utcnow() - ttl).\
+                  delete(synchronize_session=False)
+        db.session.commit()
+        click.echo('removed %d expired keys' % removed)
@@ -0,0 +1,391 @@
+import functools
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import queue
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import click
+from flask import current_app, g, send_from_directory, url_for
+
+from models import db, Venue, Artist
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow images are stored as fetched, not resized
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+#----------------------------------------------------------------------------#
+# Content-addressed thumbnail store.
+#----------------------------------------------------------------------------#
+
+# Blobs are named <sha256 of the thumbnail>.<ext>, so a name never changes
+# content and is served with a year long immutable cache. links/<sha256 of
+# the source url> holds the blob name, or "!<unix time> <error>" after a
+# failed fetch.
+IMAGE_TYPES = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+_blob_name = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _write(path, data):
+    # Other threads and processes only ever see complete files
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ImageStore(object):
+    '''Thumbnails on local disk plus the source url -> blob name links.'''
+
+    def __init__(self, root=None, cache_size=10000, recheck=60):
+        self.root = root
+        self.cache_size = cache_size
+        self.recheck = recheck
+        # Resolved links: a link never changes once it points to a blob
+        self._resolved = OrderedDict()
+        # Links not stored yet or failed: url -> (failed at or None, read at).
+        # Re-read from disk after `recheck` seconds, other processes may have
+        # fetched them since. This process's fetches update both right away.
+        self._misses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def blob_path(self, name):
+        return os.path.join(self.root, 'blobs', name[:2], name)
+
+    def link_path(self, url):
+        return os.path.join(self.root, 'links', url_key(url))
+
+    def _read_link(self, url):
+        try:
+            with open(self.link_path(url), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _remember(self, cache, url, value):
+        # Called with the lock held
+        cache[url] = value
+        cache.move_to_end(url)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def _lookup(self, url):
+        # (blob name, failed at): at most one of them set, neither when the
+        # link is not stored yet. Reads the link file only on a cache miss.
+        now = time.time()
+        with self._lock:
+            name = self._resolved.get(url)
+            if name is not None:
+                self._resolved.move_to_end(url)
+                return name, None
+            miss = self._misses.get(url)
+            if miss is not None and now - miss[1] < self.recheck:
+                return None, miss[0]
+        link = self._read_link(url)
+        with self._lock:
+            if link and not link.startswith('!'):
+                self._misses.pop(url, None)
+                self._remember(self._resolved, url, link)
+                return link, None
+            failed_at = float(link[1:].split(' ', 1)[0]) if link else None
+            self._remember(self._misses, url, (failed_at, now))
+            return None, failed_at
+
+    def resolve(self, url):
+        # The blob name of url's thumbnail, or None when it is not stored yet
+        return self._lookup(url)[0]
+
+    def failed_recently(self, url, retry_after):
+        failed_at = self._lookup(url)[1]
+        return failed_at is not None and time.time() - failed_at < retry_after
+
+    def put(self, url, data, content_type):
+        name = '%s.%s' % (hashlib.sha256(data).hexdigest(), IMAGE_TYPES[content_type])
+        path = self.blob_path(name)
+        if not os.path.exists(path):
+            _write(path, data)
+        _write(self.link_path(url), name.encode('ascii'))
+        with self._lock:
+            self._misses.pop(url, None)
+            self._remember(self._resolved, url, name)
+        return name
+
+    def fail(self, url, error):
+        now = time.time()
+        _write(self.link_path(url), ('!%d %s' % (now, error)).encode('utf-8'))
+        with self._lock:
+            self._remember(self._misses, url, (now, now))
+
+
+#----------------------------------------------------------------------------#
+# Fetching and resizing.
+#----------------------------------------------------------------------------#
+
+class FetchError(Exception):
+    pass
+
+
+def check_host(url, allow_private=False):
+    # Only http(s) to public addresses, so links cannot point the fetcher at
+    # internal services. Returns the vetted address to connect to, None when
+    # IMAGE_ALLOW_PRIVATE_HOSTS lifts the check for local stand-ins.
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise FetchError('not an http(s) url')
+    if allow_private:
+        return None
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 80, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise FetchError('cannot resolve %s: %s' % (parsed.hostname, e))
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0])
+        if not ip.is_global:
+            raise FetchError('%s resolves to non-public address %s' % (parsed.hostname, ip))
+    return addresses[0][4][0]
+
+
+class _PinnedConnection(object):
+    # Connects to the address check_host vetted instead of resolving the host
+    # again, which a DNS rebinding host could answer with an internal address.
+    # Host header, SNI and certificate checks still use the hostname.
+
+    def __init__(self, host, address=None, **kwargs):
+        super().__init__(host, **kwargs)
+        if address is not None:
+            self._create_connection = lambda target, *args: socket.create_connection((address, target[1]), *args)
+
+
+class _PinnedHTTPConnection(_PinnedConnection, http.client.HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_PinnedConnection, http.client.HTTPSConnection):
+    pass
+
+
+class _PinnedHTTPHandler(urllib.request.HTTPHandler):
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        address = check_host(req.full_url, self.allow_private)
+        return self.do_open(functools.partial(_PinnedHTTPConnection, address=address), req)
+
+
+class _PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        address = check_host(req.full_url, self.allow_private)
+        return self.do_open(functools.partial(_PinnedHTTPSConnection, address=address), req,
+                            context=self._context)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+
+    def __init__(self, allow_private):
+        self.allow_private = allow_private
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        # Refuses redirects to other schemes, the handlers above check the host
+        if urlparse(newurl).scheme not in ('http', 'https'):
+            raise FetchError('redirect to a non-http(s) url')
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, timeout=5, max_bytes=5 * 1024 * 1024, allow_private=False):
+    # (data, content type) of the image at url. Proxies from the environment
+    # are ignored, the fetcher must connect to the vetted address itself.
+    check_host(url, allow_private)
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}), _PinnedHTTPHandler(allow_private),
+        _PinnedHTTPSHandler(allow_private), _CheckedRedirects(allow_private))
+    request = urllib.request.Request(url, headers={'User-Agent': 'fyyur-thumbnailer'})
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            content_type = response.headers.get_content_type()
+            if content_type not in IMAGE_TYPES:
+                raise FetchError('not an image: %s' % content_type)
+            data = response.read(max_bytes + 1)
+    except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as e:
+        raise FetchError(str(e))
+    if len(data) > max_bytes:
+        raise FetchError('larger than %d bytes' % max_bytes)
+    return data, content_type
+
+
+def thumbnail(data, content_type, size):
+    # Fits the image in size x size, JPEG unless it has transparency
+    if Image is None:
+        return data, content_type
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((size, size))
+    except Exception as e:
+        raise FetchError('unreadable image: %s' % e)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(output, 'PNG', optimize=True)
+        return output.getvalue(), 'image/png'
+    image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue(), 'image/jpeg'
+
+
+class ImageFetcher(object):
+    '''Background threads that fetch queued image links into the store.
+
+    Pages never wait on a remote host: an unknown link is queued here and
+    the placeholder is rendered until its thumbnail is stored.
+    '''
+
+    def __init__(self, store, app=None):
+        self.store = store
+        self.app = app
+        self.queue = queue.Queue()
+        self._pending = set()
+        self._workers = []
+        self._lock = threading.Lock()
+        # Called with each link once its fetch is over, stored or failed
+        self.listeners = []
+
+    def submit(self, url):
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.app.config.get('IMAGE_FETCH_THREADS', 4):
+                worker = threading.Thread(target=self._run, name='image-fetcher', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        self.queue.put(url)
+
+    def _run(self):
+        while True:
+            url = self.queue.get()
+            try:
+                self.process(url)
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
+                for listener in self.listeners:
+                    try:
+                        listener(url)
+                    except Exception:
+                        logger.exception('listener of image %s failed', url)
+                self.queue.task_done()
+
+    def process(self, url):
+        config = self.app.config
+        try:
+            data, content_type = fetch(url, config.get('IMAGE_FETCH_TIMEOUT', 5),
+                                       config.get('IMAGE_MAX_BYTES', 5 * 1024 * 1024),
+                                       config.get('IMAGE_ALLOW_PRIVATE_HOSTS', False))
+            name = self.store.put(url, *thumbnail(data, content_type, config.get('IMAGE_THUMBNAIL_SIZE', 320)))
+            logger.info('stored %s as %s', url, name)
+            return name
+        except FetchError as e:
+            self.store.fail(url, e)
+            logger.warning('image %s: %s', url, e)
+        except Exception as e:
+            # Recorded too, pages waiting on the link would otherwise queue it again and again
+            self.store.fail(url, e)
+            logger.exception('image %s failed', url)
+
+
+store = ImageStore()
+fetcher = ImageFetcher(store)
+
+
+#----------------------------------------------------------------------------#
+# Templates and serving.
+#----------------------------------------------------------------------------#
+
+def thumbnail_url(url):
+    # `thumbnail` filter: the local thumbnail of an image link, or the
+    # placeholder while it is being fetched or when it cannot be. Memoised
+    # per request, listings repeat the same artists' images many times.
+    urls = g.setdefault('thumbnail_urls', {})
+    thumbnail = urls.get(url)
+    if thumbnail is None:
+        thumbnail = urls[url] = _thumbnail_url(url)
+    return thumbnail
+
+
+def _thumbnail_url(url):
+    config = current_app.config
+    if not config.get('IMAGE_PROXY_ENABLED', True):
+        return url
+    if url:
+        name = store.resolve(url)
+        if name is not None:
+            return url_for('image', name=name)
+        if not store.failed_recently(url, config.get('IMAGE_RETRY_AFTER', 3600)):
+            fetcher.submit(url)
+            # The page shows the placeholder only until this fetch is over
+            g.setdefault('pending_thumbnails', set()).add(url)
+    return url_for('static', filename='img/placeholder.svg')
+
+
+def send(name):
+    # Flask response for a stored blob, None for names that are not blobs
+    if not _blob_name.match(name):
+        return None
+    response = send_from_directory(os.path.dirname(store.blob_path(name)), name,
+                                   cache_timeout=current_app.config.get('IMAGE_CACHE_MAX_AGE', 365 * 24 * 3600))
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    store.root = app.config.get('IMAGE_DIR', 'images')
+    store.recheck = app.config.get('IMAGE_LINK_RECHECK', 60)
+    fetcher.app = app
+    app.jinja_env.filters['thumbnail'] = thumbnail_url
+
+    @app.cli.group('images')
+    def images():
+        '''Local thumbnails of venue and artist image links.'''
+
+    @images.command('fetch')
+    @click.option('--retry-failed', is_flag=True, help='Also refetch links that failed recently.')
+    def fetch_command(retry_failed):
+        '''Fetch every venue and artist image link that has no thumbnail yet.'''
+        urls = set()
+        for model in (Venue, Artist):
+            urls.update(url for (url,) in db.session.query(model.image_link).
+                        filter(model.image_link.isnot(None), model.deleted_at.is_(None)).distinct())
+        retry_after = 0 if retry_failed else app.config.get('IMAGE_RETRY_AFTER', 3600)
+        queued = [url for url in urls
+                  if store.resolve(url) is None and not store.failed_recently(url, retry_after)]
+        for url in queued:
+            fetcher.submit(url)
+        fetcher.queue.join()
+        stored = sum(1 for url in queued if store.resolve(url) is not None)
+        click.echo('%d links, %d fetched, %d stored, %d failed' % (
+            len(urls), len(queued), stored, len(queued) - stored))
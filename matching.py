@@ -0,0 +1,208 @@
+import heapq
+import math
+import time
+from collections import defaultdict, namedtuple
+
+import click
+from sqlalchemy import func
+
+from forms import geners_values
+from models import db, Venue, Artist, Show, Match
+
+try:
+    import numpy
+except ImportError:  # the pure Python path gives the same matches, only slower
+    numpy = None
+
+
+#----------------------------------------------------------------------------#
+# Venue/artist matching.
+#----------------------------------------------------------------------------#
+
+# Pair score = genre overlap (Jaccard of genre bitmasks) + same area bonus
+# + previous bookings bonus. Weights sum to 1.
+WEIGHTS = {'genres': 0.6, 'area': 0.25, 'history': 0.15}
+
+GENRE_BITS = {genre: 1 << i for i, genre in enumerate(geners_values)}
+
+Candidate = namedtuple('Candidate', ('id', 'area_id', 'mask'))
+
+try:
+    popcount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def popcount(value):
+        return bin(value).count('1')
+
+
+def genre_mask(genres):
+    mask = 0
+    for genre in genres or ():
+        mask |= GENRE_BITS.get(genre, GENRE_BITS['Other'])
+    return mask
+
+
+def jaccard(a, b):
+    union = popcount(a | b)
+    return popcount(a & b) / union if union else 0.0
+
+
+if numpy is not None:
+    _POPCOUNT16 = numpy.array([popcount(i) for i in range(1 << 16)], dtype=numpy.int32)
+
+    def popcount_array(masks):
+        return _POPCOUNT16[masks & 0xFFFF] + _POPCOUNT16[masks >> 16]
+
+
+class _Side(object):
+    # The entities of one side bucketed by genre mask and by (area, mask),
+    # every pair of entities in the same bucket scores identically
+    def __init__(self, candidates):
+        self.by_mask = defaultdict(list)
+        self.by_area_mask = defaultdict(list)
+        self.area_masks = defaultdict(set)
+        self.ids = {}
+        for candidate in candidates:
+            self.ids[candidate.id] = candidate
+            self.by_mask[candidate.mask].append(candidate)
+            self.by_area_mask[(candidate.area_id, candidate.mask)].append(candidate)
+            self.area_masks[candidate.area_id].add(candidate.mask)
+        self._ranked = {}
+        if numpy is not None:
+            self._masks = numpy.fromiter(self.by_mask, dtype=numpy.uint32, count=len(self.by_mask))
+            self._popcounts = popcount_array(self._masks)
+
+    def ranked_masks(self, mask, top_n):
+        # The top_n masks of this side by overlap with `mask`. Every bucket holds
+        # at least one entity, so top_n buckets always yield top_n candidates.
+        # Computed once per distinct mask, and there are few distinct masks.
+        ranked = self._ranked.get(mask)
+        if ranked is not None:
+            return ranked
+        if numpy is not None and len(self._masks) > top_n:
+            # Jaccard against every distinct mask at once
+            shared = popcount_array(self._masks & mask)
+            scores = shared / numpy.maximum(self._popcounts + popcount(mask) - shared, 1)
+            top = numpy.argpartition(-scores, top_n)[:top_n]
+            top = top[numpy.argsort(-scores[top], kind='stable')]
+            ranked = [int(self._masks[i]) for i in top if scores[i] > 0]
+        else:
+            scored = heapq.nlargest(top_n, ((jaccard(mask, other), other) for other in self.by_mask))
+            ranked = [other for score, other in scored if score > 0]
+        self._ranked[mask] = ranked
+        return ranked
+
+    def ranked_area_masks(self, mask, area_id):
+        return sorted(self.area_masks.get(area_id, ()), key=lambda other: jaccard(mask, other), reverse=True)
+
+
+def top_matches(entity, other, bookings, top_n, weights=WEIGHTS):
+    # The top_n (score, other id) for one entity. Candidates come from the best
+    # same-area buckets, the best global buckets and previous booking partners,
+    # so the work per entity is bounded by top_n rather than the other side's size.
+    pool = {}
+    passes = (
+        (other.ranked_area_masks(entity.mask, entity.area_id), lambda mask: other.by_area_mask[(entity.area_id, mask)]),
+        (other.ranked_masks(entity.mask, top_n), lambda mask: other.by_mask[mask]),
+    )
+    for ranked, bucket in passes:
+        taken = 0
+        for mask in ranked:
+            # Members of a bucket tie, so only as many as still needed are taken
+            for candidate in bucket(mask):
+                if taken >= top_n:
+                    break
+                if candidate.id not in pool:
+                    pool[candidate.id] = candidate
+                    taken += 1
+            if taken >= top_n:
+                break
+    for partner_id in bookings:
+        if partner_id not in pool and partner_id in other.ids:
+            pool[partner_id] = other.ids[partner_id]
+
+    scored = []
+    for candidate in pool.values():
+        score = weights['genres'] * jaccard(entity.mask, candidate.mask)
+        if entity.area_id is not None and candidate.area_id == entity.area_id:
+            score += weights['area']
+        count = bookings.get(candidate.id)
+        if count:
+            score += weights['history'] * min(1.0, math.log1p(count) / math.log1p(10))
+        if score > 0:
+            scored.append((score, candidate.id))
+    return heapq.nlargest(top_n, scored)
+
+
+def compute_matches(venues, artists, bookings, top_n=10, weights=WEIGHTS):
+    '''Returns {(venue_id, artist_id): score} holding the top_n matches of every entity.
+
+    venues/artists are Candidate records, bookings maps (venue_id, artist_id)
+    to the number of shows the pair already played together.
+    '''
+    venue_side, artist_side = _Side(venues), _Side(artists)
+    by_venue, by_artist = defaultdict(dict), defaultdict(dict)
+    for (venue_id, artist_id), count in bookings.items():
+        by_venue[venue_id][artist_id] = count
+        by_artist[artist_id][venue_id] = count
+
+    matches = {}
+    for venue in venues:
+        for score, artist_id in top_matches(venue, artist_side, by_venue.get(venue.id, {}), top_n, weights):
+            matches[(venue.id, artist_id)] = score
+    for artist in artists:
+        for score, venue_id in top_matches(artist, venue_side, by_artist.get(artist.id, {}), top_n, weights):
+            matches[(venue_id, artist.id)] = score
+    return matches
+
+
+#----------------------------------------------------------------------------#
+# Batch job.
+#----------------------------------------------------------------------------#
+
+def load_candidates():
+    venues = [Candidate(row.id, row.area_id, genre_mask(row.genres)) for row in
+              db.session.query(Venue.id, Venue.area_id, Venue.genres).
+              filter(Venue.seeking_talent.is_(True), Venue.deleted_at.is_(None)).yield_per(10000)]
+    artists = [Candidate(row.id, row.area_id, genre_mask(row.genres)) for row in
+               db.session.query(Artist.id, Artist.area_id, Artist.genres).
+               filter(Artist.seeking_venue.is_(True), Artist.deleted_at.is_(None)).yield_per(10000)]
+    bookings = {(row.venue_id, row.artist_id): row.count for row in
+                db.session.query(Show.venue_id, Show.artist_id, func.count().label('count')).
+                group_by(Show.venue_id, Show.artist_id).yield_per(10000)}
+    return venues, artists, bookings
+
+
+def rebuild(top_n=10, chunk_size=5000):
+    venues, artists, bookings = load_candidates()
+    matches = compute_matches(venues, artists, bookings, top_n)
+    rows = [{'venue_id': venue_id, 'artist_id': artist_id, 'score': score}
+            for (venue_id, artist_id), score in matches.items()]
+    # Swap the whole table in one transaction so pages never see a partial set
+    db.session.execute(Match.__table__.delete())
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(Match.__table__.insert(), rows[i:i + chunk_size])
+    db.session.commit()
+    return len(venues), len(artists), len(rows)
+
+
+def recommendations(column, entity_id, limit):
+    # (other id, score) rows for a detail page, read from the (id, score DESC) index
+    other = Match.artist_id if column is Match.venue_id else Match.venue_id
+    return db.session.query(other, Match.score).filter(column == entity_id).\
+        order_by(Match.score.desc()).limit(limit).all()
+
+
+def init_app(app):
+
+    @app.cli.group('matches')
+    def matches():
+        '''Precomputed venue/artist recommendations.'''
+
+    @matches.command('rebuild')
+    @click.option('--top', default=None, type=int, help='Matches kept per venue and per artist.')
+    def rebuild_command(top):
+        '''Recompute every match from genres, areas and show history.'''
+        start = time.perf_counter()
+        venues, artists, rows = rebuild(top or app.config.get('MATCHES_PER_ENTITY', 10))
+        click.echo('%d venues x %d artists: %d matches in %.1fs' % (
+            venues, artists, rows, time.perf_counter() - start))
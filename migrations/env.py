@@ -3,7 +3,7 @@ from __future__ import with_statement
 import logging
 from logging.config import fileConfig
 
-from sqlalchemy import engine_from_config
+from sqlalchemy import create_engine
 from sqlalchemy import pool
 
 from alembic import context
@@ -27,6 +27,23 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+
+def shard_urls():
+    """(name, url) of every shard: the default database, then each
+    SQLALCHEMY_BINDS entry (see sharding.py). `flask db upgrade -x shard=<name>`
+    migrates a single shard.
+    """
+    db = current_app.extensions['migrate'].db
+    binds = current_app.config.get('SQLALCHEMY_BINDS') or {}
+    shards = [None] + sorted(binds)
+    only = context.get_x_argument(as_dictionary=True).get('shard')
+    if only:
+        shards = [None if only == 'default' else only]
+    elif getattr(config.cmd_opts, 'autogenerate', False):
+        # Shards share one schema, autogenerate compares against the default one
+        shards = shards[:1]
+    return [(shard or 'default', str(db.get_engine(current_app, bind=shard).url)) for shard in shards]
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -45,13 +62,14 @@ def run_migrations_offline():
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
-    context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
-    )
+    for name, url in shard_urls():
+        logger.info('Migrating shard %s', name)
+        context.configure(
+            url=url, target_metadata=target_metadata, literal_binds=True
+        )
 
-    with context.begin_transaction():
-        context.run_migrations()
+        with context.begin_transaction():
+            context.run_migrations()
 
 
 def run_migrations_online():
@@ -72,22 +90,22 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section),
-        prefix='sqlalchemy.',
-        poolclass=pool.NullPool,
-    )
-
-    with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata,
-            process_revision_directives=process_revision_directives,
-            **current_app.extensions['migrate'].configure_args
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+    # Shards are migrated one after the other, each in its own transaction.
+    # A failure stops the run, the shards before it stay migrated.
+    for name, url in shard_urls():
+        logger.info('Migrating shard %s', name)
+        connectable = create_engine(url, poolclass=pool.NullPool)
+
+        with connectable.connect() as connection:
+            context.configure(
+                connection=connection,
+                target_metadata=target_metadata,
+                process_revision_directives=process_revision_directives,
+                **current_app.extensions['migrate'].configure_args
+            )
+
+            with context.begin_transaction():
+                context.run_migrations()
 
 
 if context.is_offline_mode():
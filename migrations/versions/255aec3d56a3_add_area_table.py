@@ -0,0 +1,59 @@
+"""Add Area table with foreign keys from Venue and Artist
+
+Revision ID: 255aec3d56a3
+Revises: b3605ada3147
+Create Date: 2020-09-02 11:24:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '255aec3d56a3'
+down_revision = 'b3605ada3147'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Area',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('city', sa.String(length=120), nullable=False),
+    sa.Column('state', sa.String(length=120), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('state', 'city', name='uq_area_state_city')
+    )
+    op.add_column('Venue', sa.Column('area_id', sa.Integer(), nullable=True))
+    op.add_column('Artist', sa.Column('area_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_venue_area_id', 'Venue', 'Area', ['area_id'], ['id'])
+    op.create_foreign_key('fk_artist_area_id', 'Artist', 'Area', ['area_id'], ['id'])
+
+    # Backfill: one Area per distinct (city, state) pair, then point rows at it
+    op.execute('''
+        INSERT INTO "Area" (city, state)
+        SELECT city, state FROM "Venue"
+        UNION
+        SELECT city, state FROM "Artist"
+    ''')
+    op.execute('''
+        UPDATE "Venue" SET area_id = "Area".id FROM "Area"
+        WHERE "Area".city = "Venue".city AND "Area".state = "Venue".state
+    ''')
+    op.execute('''
+        UPDATE "Artist" SET area_id = "Area".id FROM "Area"
+        WHERE "Area".city = "Artist".city AND "Area".state = "Artist".state
+    ''')
+
+    op.create_index('ix_venue_area_id_name', 'Venue', ['area_id', 'name'], unique=False)
+    op.create_index('ix_artist_area_id_name', 'Artist', ['area_id', 'name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_artist_area_id_name', table_name='Artist')
+    op.drop_index('ix_venue_area_id_name', table_name='Venue')
+    op.drop_constraint('fk_artist_area_id', 'Artist', type_='foreignkey')
+    op.drop_constraint('fk_venue_area_id', 'Venue', type_='foreignkey')
+    op.drop_column('Artist', 'area_id')
+    op.drop_column('Venue', 'area_id')
+    op.drop_table('Area')
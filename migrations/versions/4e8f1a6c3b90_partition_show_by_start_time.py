@@ -0,0 +1,91 @@
+"""Range partition Show by start_time
+
+Revision ID: 4e8f1a6c3b90
+Revises: 9c41e07b2d58
+Create Date: 2020-09-09 10:41:55.183320
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from dateutil.relativedelta import relativedelta
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8f1a6c3b90'
+down_revision = '9c41e07b2d58'
+branch_labels = None
+depends_on = None
+
+# Months of partitions created ahead of today, `flask partitions ensure` extends it
+MONTHS_AHEAD = 12
+
+
+def create_month_partitions(first, last):
+    month = datetime.datetime(first.year, first.month, 1)
+    while month <= last:
+        upper = month + relativedelta(months=1)
+        op.execute(
+            'CREATE TABLE "Show_y%04dm%02d" PARTITION OF "Show" '
+            "FOR VALUES FROM ('%s') TO ('%s')" % (month.year, month.month, month.isoformat(), upper.isoformat()))
+        month = upper
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.drop_index(op.f('ix_Show_artist_id'), table_name='Show')
+    op.drop_index(op.f('ix_Show_venue_id'), table_name='Show')
+    op.rename_table('Show', 'Show_unpartitioned')
+    op.execute('ALTER TABLE "Show_unpartitioned" RENAME CONSTRAINT "Show_pkey" TO "Show_unpartitioned_pkey"')
+
+    # The partition key has to be part of the primary key
+    op.execute('''
+        CREATE TABLE "Show" (
+            id INTEGER NOT NULL DEFAULT nextval('"Show_id_seq"'),
+            start_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            venue_id INTEGER NOT NULL REFERENCES "Venue" (id),
+            artist_id INTEGER NOT NULL REFERENCES "Artist" (id),
+            CONSTRAINT "Show_pkey" PRIMARY KEY (id, start_time)
+        ) PARTITION BY RANGE (start_time)
+    ''')
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY "Show".id')
+
+    today = datetime.datetime.today()
+    first = bind.execute(sa.text('SELECT min(start_time) FROM "Show_unpartitioned"')).scalar() or today
+    last = max(bind.execute(sa.text('SELECT max(start_time) FROM "Show_unpartitioned"')).scalar() or today,
+               today + relativedelta(months=MONTHS_AHEAD))
+    create_month_partitions(min(first, today), last)
+
+    op.execute('''
+        INSERT INTO "Show" (id, start_time, venue_id, artist_id)
+        SELECT id, start_time, venue_id, artist_id FROM "Show_unpartitioned"
+    ''')
+    op.drop_table('Show_unpartitioned')
+    op.create_index(op.f('ix_Show_venue_id'), 'Show', ['venue_id'], unique=False)
+    op.create_index(op.f('ix_Show_artist_id'), 'Show', ['artist_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Show_artist_id'), table_name='Show')
+    op.drop_index(op.f('ix_Show_venue_id'), table_name='Show')
+    op.rename_table('Show', 'Show_partitioned')
+    op.execute('ALTER TABLE "Show_partitioned" RENAME CONSTRAINT "Show_pkey" TO "Show_partitioned_pkey"')
+    op.create_table('Show',
+    sa.Column('id', sa.Integer(), server_default=sa.text('nextval(\'"Show_id_seq"\')'), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ),
+    sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE "Show_id_seq" OWNED BY "Show".id')
+    op.execute('''
+        INSERT INTO "Show" (id, start_time, venue_id, artist_id)
+        SELECT id, start_time, venue_id, artist_id FROM "Show_partitioned"
+    ''')
+    # Dropping the parent drops every attached partition with it
+    op.drop_table('Show_partitioned')
+    op.create_index(op.f('ix_Show_venue_id'), 'Show', ['venue_id'], unique=False)
+    op.create_index(op.f('ix_Show_artist_id'), 'Show', ['artist_id'], unique=False)
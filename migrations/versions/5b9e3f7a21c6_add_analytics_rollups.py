@@ -0,0 +1,58 @@
+"""Add analytics rollup tables
+
+Revision ID: 5b9e3f7a21c6
+Revises: c7d2e95a04b1
+Create Date: 2020-09-21 10:03:27.318442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b9e3f7a21c6'
+down_revision = 'c7d2e95a04b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('VenueDailyShows',
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('shows', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('venue_id', 'day')
+    )
+    op.create_index(op.f('ix_VenueDailyShows_day'), 'VenueDailyShows', ['day'], unique=False)
+    op.create_table('ArtistDailyShows',
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('shows', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('artist_id', 'day')
+    )
+    op.create_index(op.f('ix_ArtistDailyShows_day'), 'ArtistDailyShows', ['day'], unique=False)
+    op.create_table('GenreStateDailyShows',
+    sa.Column('state', sa.String(length=120), nullable=False),
+    sa.Column('genre', sa.String(length=120), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('shows', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('state', 'genre', 'day')
+    )
+    op.create_index(op.f('ix_GenreStateDailyShows_day'), 'GenreStateDailyShows', ['day'], unique=False)
+    op.create_table('RollupState',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('RollupState')
+    op.drop_index(op.f('ix_GenreStateDailyShows_day'), table_name='GenreStateDailyShows')
+    op.drop_table('GenreStateDailyShows')
+    op.drop_index(op.f('ix_ArtistDailyShows_day'), table_name='ArtistDailyShows')
+    op.drop_table('ArtistDailyShows')
+    op.drop_index(op.f('ix_VenueDailyShows_day'), table_name='VenueDailyShows')
+    op.drop_table('VenueDailyShows')
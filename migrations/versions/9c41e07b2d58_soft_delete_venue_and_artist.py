@@ -0,0 +1,44 @@
+"""Soft delete columns for Venue and Artist
+
+Revision ID: 9c41e07b2d58
+Revises: 255aec3d56a3
+Create Date: 2020-09-05 16:03:12.407781
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41e07b2d58'
+down_revision = '255aec3d56a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Venue', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('Artist', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    # Area browsing indexes only need live rows
+    op.drop_index('ix_venue_area_id_name', table_name='Venue')
+    op.drop_index('ix_artist_area_id_name', table_name='Artist')
+    op.create_index('ix_venue_area_id_name', 'Venue', ['area_id', 'name'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_artist_area_id_name', 'Artist', ['area_id', 'name'], unique=False,
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+
+    # The purge deletes shows by venue/artist in batches
+    op.create_index(op.f('ix_Show_venue_id'), 'Show', ['venue_id'], unique=False)
+    op.create_index(op.f('ix_Show_artist_id'), 'Show', ['artist_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Show_artist_id'), table_name='Show')
+    op.drop_index(op.f('ix_Show_venue_id'), table_name='Show')
+    op.drop_index('ix_artist_area_id_name', table_name='Artist')
+    op.drop_index('ix_venue_area_id_name', table_name='Venue')
+    op.create_index('ix_venue_area_id_name', 'Venue', ['area_id', 'name'], unique=False)
+    op.create_index('ix_artist_area_id_name', 'Artist', ['area_id', 'name'], unique=False)
+    op.drop_column('Artist', 'deleted_at')
+    op.drop_column('Venue', 'deleted_at')
@@ -0,0 +1,35 @@
+"""Add Match table for venue/artist recommendations
+
+Revision ID: ae50ec7d6f38
+Revises: 4e8f1a6c3b90
+Create Date: 2020-09-14 18:22:09.731562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ae50ec7d6f38'
+down_revision = '4e8f1a6c3b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Match',
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artist.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['venue_id'], ['Venue.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('venue_id', 'artist_id')
+    )
+    op.create_index('ix_match_venue_id_score', 'Match', ['venue_id', sa.text('score DESC')], unique=False)
+    op.create_index('ix_match_artist_id_score', 'Match', ['artist_id', sa.text('score DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_match_artist_id_score', table_name='Match')
+    op.drop_index('ix_match_venue_id_score', table_name='Match')
+    op.drop_table('Match')
@@ -0,0 +1,44 @@
+"""Idempotency keys and unique show natural key
+
+Revision ID: c7d2e95a04b1
+Revises: ae50ec7d6f38
+Create Date: 2020-09-17 09:12:48.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e95a04b1'
+down_revision = 'ae50ec7d6f38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('IdempotencyKey',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('endpoint', sa.String(length=120), nullable=False),
+    sa.Column('message', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_IdempotencyKey_created_at'), 'IdempotencyKey', ['created_at'], unique=False)
+
+    # Drop the duplicate shows double submits already created, keeping the first
+    op.execute('''
+        DELETE FROM "Show" duplicate USING "Show" original
+        WHERE duplicate.venue_id = original.venue_id
+          AND duplicate.artist_id = original.artist_id
+          AND duplicate.start_time = original.start_time
+          AND duplicate.id > original.id
+    ''')
+    # Includes start_time, the partition key, as unique constraints on partitioned tables must
+    op.create_unique_constraint('uq_show_venue_artist_start_time', 'Show', ['venue_id', 'artist_id', 'start_time'])
+
+
+def downgrade():
+    op.drop_constraint('uq_show_venue_artist_start_time', 'Show', type_='unique')
+    op.drop_index(op.f('ix_IdempotencyKey_created_at'), table_name='IdempotencyKey')
+    op.drop_table('IdempotencyKey')
@@ -0,0 +1,32 @@
+"""Scope idempotency keys to their endpoint
+
+Revision ID: d3f1a8b6c2e4
+Revises: 5b9e3f7a21c6
+Create Date: 2020-09-23 15:41:09.207531
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f1a8b6c2e4'
+down_revision = '5b9e3f7a21c6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('IdempotencyKey_pkey', 'IdempotencyKey', type_='primary')
+    op.create_primary_key('IdempotencyKey_pkey', 'IdempotencyKey', ['key', 'endpoint'])
+
+
+def downgrade():
+    # The same key may now exist for several endpoints, keep the oldest
+    op.execute('''
+        DELETE FROM "IdempotencyKey" newer USING "IdempotencyKey" older
+        WHERE newer.key = older.key
+          AND (newer.created_at, newer.endpoint) > (older.created_at, older.endpoint)
+    ''')
+    op.drop_constraint('IdempotencyKey_pkey', 'IdempotencyKey', type_='primary')
+    op.create_primary_key('IdempotencyKey_pkey', 'IdempotencyKey', ['key'])
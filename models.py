@@ -1,7 +1,19 @@
-from flask_sqlalchemy import SQLAlchemy
 import datetime
+import os
 
-db = SQLAlchemy()
+from sqlalchemy.exc import IntegrityError
+
+from sharding import ShardedSQLAlchemy
+
+# Statements go to the shard of the current request, see sharding.py
+db = ShardedSQLAlchemy()
+
+# SQLALCHEMY_RAISELOAD=1 (CI, profiling) turns any relationship load that would
+# hit the database into an error, so new N+1 patterns fail loudly
+RELATIONSHIP_LAZY = 'raise_on_sql' if os.environ.get('SQLALCHEMY_RAISELOAD') == '1' else True
+
+# Genre lists are Postgres arrays, stored as JSON on the SQLite stand-in used by seeding.py
+GenreList = db.ARRAY(db.String).with_variant(db.JSON(), 'sqlite')
 
 
 
@@ -9,8 +21,48 @@ db = SQLAlchemy()
 # Models.
 #----------------------------------------------------------------------------#
 
-class Venue(db.Model):
+class SoftDeleteMixin(object):
+    # Rows are first marked deleted and later removed by purge.py
+    deleted_at = db.Column(db.DateTime(), nullable=True)
+
+    @classmethod
+    def active(cls):
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+class Area(db.Model):
+    __tablename__ = 'Area'
+    __table_args__ = (
+        db.UniqueConstraint('state', 'city', name='uq_area_state_city'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    city = db.Column(db.String(120), nullable=False)
+    state = db.Column(db.String(120), nullable=False)
+
+    venues = db.relationship('Venue', backref=db.backref('area', lazy=RELATIONSHIP_LAZY), lazy=RELATIONSHIP_LAZY)
+    artists = db.relationship('Artist', backref=db.backref('area', lazy=RELATIONSHIP_LAZY), lazy=RELATIONSHIP_LAZY)
+
+    @classmethod
+    def for_location(cls, city, state):
+        # Returns the Area row for (city, state), inserting it if it is new. The
+        # insert runs in a savepoint: when a concurrent request inserted the
+        # same city first, only the savepoint is rolled back and its row is used.
+        area = cls.query.filter_by(state=state, city=city).first()
+        if area is None:
+            try:
+                with db.session.begin_nested():
+                    area = cls(city=city, state=state)
+                    db.session.add(area)
+            except IntegrityError:
+                area = cls.query.filter_by(state=state, city=city).one()
+        return area
+
+class Venue(SoftDeleteMixin, db.Model):
     __tablename__ = 'Venue'
+    __table_args__ = (
+        db.Index('ix_venue_area_id_name', 'area_id', 'name',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -18,39 +70,107 @@ class Venue(db.Model):
     state = db.Column(db.String(120), nullable=False)
     address = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(120), nullable=False)
-    genres = db.Column(db.ARRAY(db.String), nullable=False)
+    genres = db.Column(GenreList, nullable=False)
     image_link = db.Column(db.String(500), nullable=True)
     facebook_link = db.Column(db.String(120), nullable=False)
     website = db.Column(db.String(120), nullable=True)
     seeking_talent = db.Column(db.Boolean(), nullable=True)
     seeking_description = db.Column(db.Text(), nullable=True)
+    area_id = db.Column(db.Integer, db.ForeignKey('Area.id'), nullable=True)
     
-    shows = db.relationship('Show', backref='venue', lazy=True)
+    shows = db.relationship('Show', backref=db.backref('venue', lazy=RELATIONSHIP_LAZY), lazy=RELATIONSHIP_LAZY)
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
-class Artist(db.Model):
+class Artist(SoftDeleteMixin, db.Model):
     __tablename__ = 'Artist'
+    __table_args__ = (
+        db.Index('ix_artist_area_id_name', 'area_id', 'name',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     city = db.Column(db.String(120), nullable=False)
     state = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(120), nullable=False)
-    genres = db.Column(db.ARRAY(db.String), nullable=False)
+    genres = db.Column(GenreList, nullable=False)
     image_link = db.Column(db.String(500), nullable=True)
     facebook_link = db.Column(db.String(120), nullable=False)
     website = db.Column(db.String(120), nullable=True)
     seeking_venue = db.Column(db.Boolean(), nullable=True)
     seeking_description = db.Column(db.Text(), nullable=True)
+    area_id = db.Column(db.Integer, db.ForeignKey('Area.id'), nullable=True)
 
-    shows = db.relationship('Show', backref='artist', lazy=True)
+    shows = db.relationship('Show', backref=db.backref('artist', lazy=RELATIONSHIP_LAZY), lazy=RELATIONSHIP_LAZY)
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
 # TODO Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
 class Show(db.Model):
     __tablename__ = 'Show'
-    id = db.Column(db.Integer, primary_key=True)
-    start_time = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow)
-    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
-    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)
\ No newline at end of file
+    # Monthly range partitions are managed by partitions.py
+    __table_args__ = (
+        db.UniqueConstraint('venue_id', 'artist_id', 'start_time', name='uq_show_venue_artist_start_time'),
+        {'postgresql_partition_by': 'RANGE (start_time)'},
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    start_time = db.Column(db.DateTime(), primary_key=True, nullable=False, default=datetime.datetime.utcnow)
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False, index=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False, index=True)
+
+class Match(db.Model):
+    __tablename__ = 'Match'
+    # Precomputed venue/artist recommendations, rebuilt by `flask matches rebuild`
+    __table_args__ = (
+        db.Index('ix_match_venue_id_score', 'venue_id', db.text('score DESC')),
+        db.Index('ix_match_artist_id_score', 'artist_id', db.text('score DESC')),
+    )
+
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), primary_key=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Float(), nullable=False)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'IdempotencyKey'
+    # Outcome of a create submission, replayed when the same form is posted again
+
+    # Keys are scoped to the create route they were posted to
+    key = db.Column(db.String(64), primary_key=True)
+    endpoint = db.Column(db.String(120), primary_key=True)
+    message = db.Column(db.Text(), nullable=False)
+    created_at = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.utcnow, index=True)
+
+#----------------------------------------------------------------------------#
+# Analytics rollups, maintained by analytics.py.
+#----------------------------------------------------------------------------#
+
+class VenueDailyShows(db.Model):
+    __tablename__ = 'VenueDailyShows'
+
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True, index=True)
+    shows = db.Column(db.Integer, nullable=False)
+
+class ArtistDailyShows(db.Model):
+    __tablename__ = 'ArtistDailyShows'
+
+    artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True, index=True)
+    shows = db.Column(db.Integer, nullable=False)
+
+class GenreStateDailyShows(db.Model):
+    __tablename__ = 'GenreStateDailyShows'
+    # A show counts once for each genre of its artist, in the state of its venue
+
+    state = db.Column(db.String(120), primary_key=True)
+    genre = db.Column(db.String(120), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True, index=True)
+    shows = db.Column(db.Integer, nullable=False)
+
+class RollupState(db.Model):
+    __tablename__ = 'RollupState'
+    # Watermarks of the nightly rollup catch-up, e.g. the last Show id rolled up
+
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False)
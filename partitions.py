@@ -0,0 +1,165 @@
+import datetime
+import gzip
+import os
+import re
+
+import click
+import dateutil.parser
+from dateutil.relativedelta import relativedelta
+from flask import current_app
+from sqlalchemy import event, text
+
+from models import db
+import sharding
+
+
+#----------------------------------------------------------------------------#
+# Monthly range partitions of the Show table.
+#----------------------------------------------------------------------------#
+
+# Partitions are named after the month they hold, e.g. Show_y2020m09
+_partition_name = re.compile(r'^Show_y(\d{4})m(\d{2})$')
+# (shard, month) of partitions known to exist. Months are only recorded once
+# the transaction that used them commits, and a rollback forgets them: the
+# partition may be gone (archived by another process), the next insert checks
+# again.
+_known_months = set()
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def partition_name(month):
+    return 'Show_y%04dm%02d' % (month.year, month.month)
+
+
+def ensure_partition(start_time, lock_timeout=None):
+    # Creates the partition holding start_time unless this process knows it
+    # exists. The CREATE locks "Show", so it runs in its own short transaction
+    # on a separate connection instead of holding that lock until the caller
+    # commits, and gives up after lock_timeout ms (SHOW_PARTITION_LOCK_TIMEOUT).
+    # `partitions ensure` creates the coming months ahead of time, requests
+    # only get here for dates past that window.
+    if isinstance(start_time, str):
+        start_time = dateutil.parser.parse(start_time)
+    key = (sharding.current_shard(), month_start(start_time))
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    used = db.session.info.setdefault('partition_months', set())
+    if key not in _known_months and key not in used:
+        if lock_timeout is None:
+            lock_timeout = current_app.config.get('SHOW_PARTITION_LOCK_TIMEOUT', 500)
+        create_partition(key[1], lock_timeout)
+    used.add(key)
+
+
+def create_partition(month, lock_timeout):
+    name = partition_name(month)
+    with sharding.engine().begin() as connection:
+        connection.execute("SET LOCAL lock_timeout = '%dms'" % lock_timeout)
+        if connection.execute(text('SELECT to_regclass(:name)'), name='"%s"' % name).scalar() is None:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" PARTITION OF "Show" '
+                "FOR VALUES FROM ('%s') TO ('%s')" % (
+                    name, month.isoformat(), (month + relativedelta(months=1)).isoformat()))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _remember_months(session):
+    _known_months.update(session.info.pop('partition_months', ()))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_months(session):
+    _known_months.difference_update(session.info.pop('partition_months', ()))
+
+
+def ensure_partitions(months_ahead=12, today=None):
+    month = month_start(today or datetime.datetime.today())
+    for _ in range(months_ahead + 1):
+        ensure_partition(month)
+        month += relativedelta(months=1)
+    db.session.commit()
+
+
+def list_partitions():
+    # The "Show" the search_path resolves to, shards may be schemas of one database
+    rows = db.session.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON pg_inherits.inhrelid = child.oid '
+        'WHERE pg_inherits.inhparent = \'"Show"\'::regclass ORDER BY child.relname')
+    partitions = []
+    for (name,) in rows:
+        match = _partition_name.match(name)
+        if match:
+            partitions.append((datetime.datetime(int(match.group(1)), int(match.group(2)), 1), name))
+    return partitions
+
+
+def archive_partition(name, directory, lock_timeout=2000):
+    # Streams the partition to <directory>/<name>.csv.gz with COPY, then
+    # detaches and drops it. Returns the archive path.
+    #
+    # The copy only locks the partition itself, EXCLUSIVE so writes to that
+    # month wait (and cannot be lost with the drop) while reads of "Show" go
+    # on. DETACH needs ACCESS EXCLUSIVE on "Show", it is taken last and given
+    # up after lock_timeout ms instead of queueing every browsing query behind it.
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + '.csv.gz')
+    connection = sharding.engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('LOCK TABLE "%s" IN EXCLUSIVE MODE' % name)
+        with gzip.open(path, 'wb') as archive:
+            cursor.copy_expert('COPY "%s" TO STDOUT WITH CSV HEADER' % name, archive)
+        cursor.execute("SET LOCAL lock_timeout = '%dms'" % lock_timeout)
+        cursor.execute('ALTER TABLE "Show" DETACH PARTITION "%s"' % name)
+        cursor.execute('DROP TABLE "%s"' % name)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        connection.close()
+    _known_months.discard((sharding.current_shard(), month_start(datetime.datetime.strptime(name, 'Show_y%Ym%m'))))
+    return path
+
+
+def init_app(app):
+
+    @app.cli.group('partitions')
+    def partitions():
+        '''Manage the monthly partitions of the Show table.'''
+
+    @partitions.command('ensure')
+    @click.option('--months-ahead', default=None, type=int)
+    def ensure(months_ahead):
+        '''Create partitions from this month up to --months-ahead.'''
+        if months_ahead is None:
+            months_ahead = app.config.get('SHOW_PARTITION_MONTHS_AHEAD', 12)
+        ensure_partitions(months_ahead)
+        click.echo('partitions ready through %s' % partition_name(
+            month_start(datetime.datetime.today()) + relativedelta(months=months_ahead)))
+
+    @partitions.command('list')
+    def list_command():
+        '''List the attached partitions.'''
+        for month, name in list_partitions():
+            click.echo(name)
+
+    @partitions.command('archive')
+    @click.option('--older-than-months', default=None, type=int)
+    @click.option('--directory', default=None)
+    def archive(older_than_months, directory):
+        '''Detach partitions older than the cutoff and archive them to gzip files.'''
+        if older_than_months is None:
+            older_than_months = app.config.get('SHOW_ARCHIVE_AFTER_MONTHS', 24)
+        directory = directory or app.config.get('SHOW_ARCHIVE_DIR', 'archive')
+        cutoff = month_start(datetime.datetime.today()) - relativedelta(months=older_than_months)
+        lock_timeout = app.config.get('SHOW_ARCHIVE_LOCK_TIMEOUT', 2000)
+        for month, name in list_partitions():
+            if month < cutoff:
+                click.echo('archived %s to %s' % (name, archive_partition(name, directory, lock_timeout)))
@@ -0,0 +1,156 @@
+import cProfile
+import datetime
+import hmac
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+
+import click
+from flask import current_app, g, request
+
+from query_budget import QueryBudget
+
+
+#----------------------------------------------------------------------------#
+# On-demand request profiling.
+#----------------------------------------------------------------------------#
+
+# A request is profiled when it carries PROFILE_HEADER set to PROFILE_TOKEN,
+# or is picked at PROFILE_SAMPLE_RATE. With neither configured the hooks are
+# not installed at all.
+PROFILE_HEADER = 'X-Profile'
+
+
+def wanted():
+    token = current_app.config.get('PROFILE_TOKEN')
+    if token and hmac.compare_digest(request.headers.get(PROFILE_HEADER, ''), token):
+        return 'header'
+    rate = current_app.config.get('PROFILE_SAMPLE_RATE', 0)
+    if rate and random.random() < rate:
+        return 'sample'
+    return None
+
+
+def start():
+    trigger = wanted()
+    if trigger is None:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is already active in this process
+        return
+    queries = QueryBudget(float('inf'), 'profile').__enter__()
+    g.profile = (profiler, queries, trigger, time.perf_counter(), time.thread_time())
+
+
+def stop():
+    # Returns the profile's metadata, or None when the request was not profiled
+    state = g.pop('profile', None)
+    if state is None:
+        return None
+    profiler, queries, trigger, wall, cpu = state
+    profiler.disable()
+    queries.__exit__(None, None, None)
+    return profiler, {
+        'endpoint': request.endpoint,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'trigger': trigger,
+        'queries': queries.count,
+        'wall_ms': round((time.perf_counter() - wall) * 1000, 2),
+        'cpu_ms': round((time.thread_time() - cpu) * 1000, 2),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+def save(directory, profiler, meta):
+    # <directory>/<id>.prof (pstats) next to <id>.json (meta). Returns the id.
+    os.makedirs(directory, exist_ok=True)
+    profile_id = '%s-%s-%s' % (datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'),
+                               (meta['endpoint'] or 'unknown').replace('.', '_'), uuid.uuid4().hex[:6])
+    profiler.dump_stats(os.path.join(directory, profile_id + '.prof'))
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+        json.dump(meta, f)
+    return profile_id
+
+
+def load_profiles(directory):
+    # [(id, meta)], newest first
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name)) as f:
+                profiles.append((name[:-len('.json')], json.load(f)))
+    return profiles
+
+
+def init_app(app):
+    directory = app.config.get('PROFILE_DIR', 'profiles')
+
+    if app.config.get('PROFILE_TOKEN') or app.config.get('PROFILE_SAMPLE_RATE'):
+
+        @app.before_request
+        def start_profile():
+            start()
+
+        @app.after_request
+        def save_profile(response):
+            result = stop()
+            if result is not None:
+                response.headers['X-Profile-Id'] = save(directory, *result)
+            return response
+
+        @app.teardown_request
+        def discard_profile(exc):
+            # Requests that failed before after_request ran
+            if 'profile' in g:
+                stop()
+
+    @app.cli.group('profiles')
+    def profiles():
+        '''Inspect request profiles captured to PROFILE_DIR.'''
+
+    @profiles.command('list')
+    @click.option('--endpoint', default=None)
+    @click.option('--limit', default=20, type=int)
+    def list_command(endpoint, limit):
+        '''List captured profiles, newest first.'''
+        shown = [(profile_id, meta) for profile_id, meta in load_profiles(directory)
+                 if endpoint is None or meta['endpoint'] == endpoint][:limit]
+        for profile_id, meta in shown:
+            click.echo('%s  %-7s %9.1fms wall %9.1fms cpu %4d queries  %s %s' % (
+                profile_id, meta['trigger'], meta['wall_ms'], meta['cpu_ms'],
+                meta['queries'], meta['method'], meta['path']))
+
+    @profiles.command('show')
+    @click.argument('profile_id')
+    @click.option('--sort', default='cumulative', help='pstats sort key, e.g. cumulative or tottime.')
+    @click.option('--limit', default=25, type=int)
+    def show_command(profile_id, sort, limit):
+        '''Print the slowest functions of one profile.'''
+        path = os.path.join(directory, profile_id)
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        click.echo('%(method)s %(path)s (%(endpoint)s): %(wall_ms).1fms wall, '
+                   '%(cpu_ms).1fms cpu, %(queries)d queries' % meta)
+        stats = pstats.Stats(path + '.prof', stream=click.get_text_stream('stdout'))
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+    @profiles.command('summary')
+    def summary_command():
+        '''Per endpoint: profile count and median/worst wall time and queries.'''
+        by_endpoint = {}
+        for profile_id, meta in load_profiles(directory):
+            by_endpoint.setdefault(meta['endpoint'], []).append(meta)
+        for endpoint, metas in sorted(by_endpoint.items(), key=lambda item: str(item[0])):
+            walls = sorted(meta['wall_ms'] for meta in metas)
+            queries = sorted(meta['queries'] for meta in metas)
+            click.echo('%-24s %4d profiles  wall %8.1fms median %8.1fms max  queries %d median %d max' % (
+                endpoint, len(metas), walls[len(walls) // 2], walls[-1],
+                queries[len(queries) // 2], queries[-1]))
@@ -0,0 +1,98 @@
+import logging
+import queue
+import threading
+
+import click
+
+from models import db, Venue, Artist, Show
+import analytics
+import sharding
+
+logger = logging.getLogger(__name__)
+
+
+#----------------------------------------------------------------------------#
+# Batched purge of soft-deleted venues and artists.
+#----------------------------------------------------------------------------#
+
+def purge_entity(model, entity_id, batch_size=500):
+    # Deletes the entity's shows in batches, committing after each one so no
+    # single transaction holds locks on a large set of rows, then the entity.
+    fk = Show.venue_id if model is Venue else Show.artist_id
+    removed = 0
+    days = set()
+    while True:
+        rows = db.session.query(Show.id, Show.start_time).filter(fk == entity_id).limit(batch_size).all()
+        if not rows:
+            break
+        Show.query.filter(Show.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        removed += len(rows)
+        days.update(row.start_time.date() for row in rows)
+    model.query.filter(model.id == entity_id, model.deleted_at.isnot(None)).\
+        delete(synchronize_session=False)
+    db.session.commit()
+    # Bulk deletes skip the session events, so the rollups are told directly
+    analytics.worker.submit(days)
+    return removed
+
+
+class PurgeWorker(object):
+    '''Single background thread that works through queued purges.
+
+    The delete routes only mark a row deleted and enqueue it here, so the
+    request returns without touching the entity's shows.
+    '''
+
+    def __init__(self, app=None):
+        self.app = app
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, model, entity_id):
+        self.queue.put((model, entity_id, sharding.current_shard()))
+        self._ensure_started()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='purge-worker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        batch_size = self.app.config.get('PURGE_BATCH_SIZE', 500)
+        while True:
+            model, entity_id, shard = self.queue.get()
+            with self.app.app_context(), sharding.use(shard):
+                try:
+                    removed = purge_entity(model, entity_id, batch_size)
+                    logger.info('purged %s %s and %d shows', model.__tablename__, entity_id, removed)
+                except Exception:
+                    db.session.rollback()
+                    # The row stays soft-deleted, `flask purge-deleted` picks it up later
+                    logger.exception('purge of %s %s failed', model.__tablename__, entity_id)
+                finally:
+                    db.session.remove()
+                    self.queue.task_done()
+
+
+worker = PurgeWorker()
+
+
+def init_app(app):
+    worker.app = app
+
+    @app.cli.command('purge-deleted')
+    @click.option('--batch-size', default=None, type=int, help='Shows deleted per transaction.')
+    def purge_deleted(batch_size):
+        '''Purge every soft-deleted venue and artist still in the database.'''
+        batch_size = batch_size or app.config.get('PURGE_BATCH_SIZE', 500)
+        for model in (Venue, Artist):
+            ids = [row.id for row in
+                   db.session.query(model.id).filter(model.deleted_at.isnot(None))]
+            for entity_id in ids:
+                removed = purge_entity(model, entity_id, batch_size)
+                click.echo('%s %s: removed %d shows' % (model.__tablename__, entity_id, removed))
+        # Let the rollups catch up before the process exits
+        analytics.worker.queue.join()
@@ -0,0 +1,80 @@
+import functools
+import logging
+import threading
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+_active = threading.local()
+
+
+#----------------------------------------------------------------------------#
+# Query budgets.
+#----------------------------------------------------------------------------#
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for budget in getattr(_active, 'stack', ()):
+        budget.statements.append(statement)
+
+
+class QueryBudget(object):
+    '''Counts the SQL statements run inside the block.
+
+    Going over ``max_queries`` raises QueryBudgetExceeded when the app is
+    testing or QUERY_BUDGET_RAISE is set, and logs an error otherwise:
+
+        with QueryBudget(3, 'shows'):
+            client.get('/shows')
+    '''
+
+    def __init__(self, max_queries, label=None):
+        self.max_queries = max_queries
+        self.label = label
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(_active, 'stack'):
+            _active.stack = []
+        _active.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _active.stack.remove(self)
+        if exc_type is None and self.count > self.max_queries:
+            self.exceeded()
+        return False
+
+    def exceeded(self):
+        message = '%s ran %d queries, budget is %d:\n%s' % (
+            self.label or 'block', self.count, self.max_queries,
+            '\n'.join('  ' + statement.replace('\n', ' ') for statement in self.statements))
+        if has_app_context() and not (current_app.testing or current_app.config.get('QUERY_BUDGET_RAISE')):
+            logger.error(message)
+        else:
+            raise QueryBudgetExceeded(message)
+
+
+def query_budget(max_queries):
+    # Declares the query budget of a view, checked on every request when
+    # QUERY_BUDGET_ENABLED is set (debug, tests, CI)
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('QUERY_BUDGET_ENABLED'):
+                return view(*args, **kwargs)
+            with QueryBudget(max_queries, request.endpoint):
+                return view(*args, **kwargs)
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
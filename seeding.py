@@ -0,0 +1,288 @@
+import csv
+import datetime
+import io
+import os
+import random
+import shutil
+import sqlite3
+import tarfile
+import time
+
+import click
+import dateutil.parser
+from dateutil.relativedelta import relativedelta
+
+from forms import state_values, geners_values
+from models import db, Area, Venue, Artist, Show
+import partitions
+import sharding
+
+
+#----------------------------------------------------------------------------#
+# Deterministic catalog generation.
+#----------------------------------------------------------------------------#
+
+CITY_WORDS = ['Spring', 'River', 'Oak', 'Lake', 'Hill', 'Cedar', 'Maple', 'Pine', 'Fair', 'Green']
+CITY_SUFFIXES = ['field', 'ton', 'view', 'port', 'wood', ' City', 'dale', 'burg']
+NAME_WORDS = ['Blue', 'Velvet', 'Electric', 'Golden', 'Midnight', 'Silver', 'Wild', 'Crimson',
+              'Lucky', 'Neon', 'Hollow', 'Iron', 'Paper', 'Rolling', 'Echo', 'Copper']
+VENUE_NOUNS = ['Room', 'Hall', 'Lounge', 'Theatre', 'Club', 'Garden', 'Tavern', 'Stage', 'Cellar']
+ARTIST_NOUNS = ['Band', 'Collective', 'Quartet', 'Trio', 'Orchestra', 'Project', 'Sisters', 'Kings']
+
+SIZES = {
+    'small': dict(areas=20, venues=100, artists=300, shows=2000),
+    'medium': dict(areas=200, venues=2000, artists=10000, shows=100000),
+    'large': dict(areas=1000, venues=20000, artists=100000, shows=2000000),
+}
+
+
+def skewed_choice(rng, count, skew):
+    # Zipf-like pick from range(count): low indexes are picked far more often
+    return min(count - 1, int(count * rng.random() ** skew))
+
+
+def generate(rng, areas, venues, artists, shows, hot_venues=10, hot_share=0.3, skew=3.0, now=None):
+    '''Yields (table, rows) batches of a catalog built only from `rng`.
+
+    `hot_venues` venues get `hot_share` of all shows, the remaining shows
+    and all area and artist picks are Zipf skewed by `skew`.
+    '''
+    now = now or datetime.datetime(2020, 9, 1)
+    area_rows = []
+    seen = set()
+    while len(area_rows) < areas:
+        city = rng.choice(CITY_WORDS) + rng.choice(CITY_SUFFIXES)
+        state = rng.choice(state_values)
+        if (city, state) not in seen:
+            seen.add((city, state))
+            area_rows.append({'id': len(area_rows) + 1, 'city': city, 'state': state})
+    yield Area.__table__, area_rows
+
+    def entity(i, nouns, extra):
+        area = area_rows[skewed_choice(rng, areas, skew)]
+        row = {
+            'id': i,
+            'name': 'The %s %s %d' % (rng.choice(NAME_WORDS), rng.choice(nouns), i),
+            'city': area['city'],
+            'state': area['state'],
+            'area_id': area['id'],
+            'phone': '%03d-%03d-%04d' % (rng.randrange(200, 999), rng.randrange(1000), rng.randrange(10000)),
+            'genres': rng.sample(geners_values, rng.randint(1, 3)),
+            'image_link': 'https://images.example.com/%d.jpg' % rng.randrange(10000),
+            'facebook_link': 'https://www.facebook.com/%d' % i,
+            'website': None,
+            'seeking_description': None,
+            'deleted_at': None,
+        }
+        row.update(extra)
+        return row
+
+    yield Venue.__table__, [entity(i, VENUE_NOUNS, {
+        'address': '%d %s Street' % (rng.randrange(1, 9999), rng.choice(NAME_WORDS)),
+        'seeking_talent': rng.random() < 0.4,
+    }) for i in range(1, venues + 1)]
+    yield Artist.__table__, [entity(i, ARTIST_NOUNS, {
+        'seeking_venue': rng.random() < 0.4,
+    }) for i in range(1, artists + 1)]
+
+    span = int((now + relativedelta(months=6) - (now - relativedelta(years=2))).total_seconds() // 3600)
+    start = now - relativedelta(years=2)
+    keys = set()
+    batch = []
+    while len(keys) < shows:
+        if rng.random() < hot_share:
+            venue_id = rng.randrange(1, min(hot_venues, venues) + 1)
+        else:
+            venue_id = skewed_choice(rng, venues, skew) + 1
+        artist_id = skewed_choice(rng, artists, skew) + 1
+        start_time = start + datetime.timedelta(hours=rng.randrange(span))
+        if (venue_id, artist_id, start_time) in keys:
+            continue
+        keys.add((venue_id, artist_id, start_time))
+        batch.append({'id': len(keys), 'start_time': start_time, 'venue_id': venue_id, 'artist_id': artist_id})
+        if len(batch) == 10000:
+            yield Show.__table__, batch
+            batch = []
+    if batch:
+        yield Show.__table__, batch
+
+
+#----------------------------------------------------------------------------#
+# Schema, loading and snapshots.
+#----------------------------------------------------------------------------#
+
+SQLITE_SHOW_DDL = '''
+    CREATE TABLE "Show" (
+        id INTEGER PRIMARY KEY,
+        start_time DATETIME NOT NULL,
+        venue_id INTEGER NOT NULL REFERENCES "Venue" (id),
+        artist_id INTEGER NOT NULL REFERENCES "Artist" (id),
+        CONSTRAINT uq_show_venue_artist_start_time UNIQUE (venue_id, artist_id, start_time)
+    )
+'''
+
+
+def is_sqlite():
+    return sharding.engine().dialect.name == 'sqlite'
+
+
+def create_schema():
+    # Postgres is set up by the migrations. The SQLite stand-in has no
+    # partitioning, and Show keeps id as its only key so SQLite assigns ids.
+    if not is_sqlite():
+        return
+    engine = sharding.engine()
+    tables = [table for table in db.metadata.sorted_tables if table.name != 'Show']
+    db.metadata.create_all(engine, tables=tables)
+    if not engine.has_table('Show'):
+        engine.execute(SQLITE_SHOW_DDL)
+        for index in Show.__table__.indexes:
+            index.create(engine)
+
+
+def reset_sequences():
+    if is_sqlite():
+        return
+    for table in ('Area', 'Venue', 'Artist', 'Show'):
+        db.session.execute(
+            'SELECT setval(pg_get_serial_sequence(\'"%s"\', \'id\'), coalesce(max(id), 1)) FROM "%s"'
+            % (table, table))
+
+
+def load(batches):
+    counts = {}
+    for table, rows in batches:
+        if table is Show.__table__:
+            for month in {partitions.month_start(row['start_time']) for row in rows}:
+                partitions.ensure_partition(month)
+        db.session.execute(table.insert(), rows)
+        counts[table.name] = counts.get(table.name, 0) + len(rows)
+    reset_sequences()
+    db.session.commit()
+    return counts
+
+
+def snapshot_tables():
+    return list(db.metadata.sorted_tables)
+
+
+def dump(path):
+    # SQLite: an online backup of the database file. Postgres: one COPY CSV
+    # per table in a gzipped tarball.
+    if is_sqlite():
+        source = sqlite3.connect(sharding.engine().url.database)
+        target = sqlite3.connect(path)
+        with target:
+            source.backup(target)
+        source.close()
+        target.close()
+        return
+    connection = sharding.engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        with tarfile.open(path, 'w:gz') as archive:
+            for table in snapshot_tables():
+                buffer = io.BytesIO()
+                # COPY TO refuses partitioned tables such as "Show", a query works for every table
+                cursor.copy_expert('COPY (SELECT * FROM "%s") TO STDOUT WITH CSV HEADER' % table.name, buffer)
+                info = tarfile.TarInfo(table.name + '.csv')
+                info.size = buffer.tell()
+                buffer.seek(0)
+                archive.addfile(info, buffer)
+    finally:
+        connection.close()
+
+
+def restore(path):
+    if is_sqlite():
+        engine = sharding.engine()
+        db.session.remove()
+        engine.dispose()
+        shutil.copyfile(path, engine.url.database)
+        return
+    with tarfile.open(path, 'r:gz') as archive:
+        # The partitions the snapshot's shows fall in must exist before COPY
+        first, last = show_span(archive.extractfile('Show.csv'))
+        month = first
+        while month and month <= last:
+            partitions.ensure_partition(month)
+            month += relativedelta(months=1)
+        db.session.commit()
+        connection = sharding.engine().raw_connection()
+        try:
+            cursor = connection.cursor()
+            tables = snapshot_tables()
+            cursor.execute('TRUNCATE %s CASCADE' % ', '.join('"%s"' % table.name for table in tables))
+            for table in tables:
+                try:
+                    member = archive.extractfile(table.name + '.csv')
+                except KeyError:
+                    continue
+                cursor.copy_expert('COPY "%s" FROM STDIN WITH CSV HEADER' % table.name, member)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+    reset_sequences()
+    db.session.commit()
+
+
+def show_span(csv_file):
+    # (first month, last month) of the start_time column of a Show CSV
+    reader = csv.DictReader(io.TextIOWrapper(csv_file, encoding='utf-8'))
+    first = last = None
+    for row in reader:
+        start_time = row['start_time']
+        first = min(first or start_time, start_time)
+        last = max(last or start_time, start_time)
+    if first is None:
+        return None, None
+    return (partitions.month_start(dateutil.parser.parse(first)),
+            partitions.month_start(dateutil.parser.parse(last)))
+
+
+def init_app(app):
+
+    @app.cli.group('seed')
+    def seed():
+        '''Generate, snapshot and restore test/benchmark catalogs.'''
+
+    @seed.command('generate')
+    @click.option('--size', type=click.Choice(sorted(SIZES)), default='small')
+    @click.option('--venues', type=int, default=None)
+    @click.option('--artists', type=int, default=None)
+    @click.option('--shows', type=int, default=None)
+    @click.option('--hot-venues', type=int, default=10, help='Venues that get --hot-share of all shows.')
+    @click.option('--hot-share', type=float, default=0.3)
+    @click.option('--skew', type=float, default=3.0, help='Zipf skew of area, venue and artist picks.')
+    @click.option('--seed', 'seed_value', type=int, default=42)
+    def generate_command(size, venues, artists, shows, hot_venues, hot_share, skew, seed_value):
+        '''Fill an empty database with a deterministic catalog.'''
+        counts = dict(SIZES[size])
+        for key, value in (('venues', venues), ('artists', artists), ('shows', shows)):
+            if value is not None:
+                counts[key] = value
+        start = time.perf_counter()
+        create_schema()
+        loaded = load(generate(random.Random(seed_value), hot_venues=hot_venues,
+                               hot_share=hot_share, skew=skew, **counts))
+        click.echo('%s in %.1fs' % (', '.join('%d %s' % (n, t) for t, n in loaded.items()),
+                                     time.perf_counter() - start))
+
+    @seed.command('dump')
+    @click.argument('path')
+    def dump_command(path):
+        '''Snapshot the database to PATH.'''
+        start = time.perf_counter()
+        dump(path)
+        click.echo('wrote %s (%d KiB) in %.1fs' % (path, os.path.getsize(path) // 1024, time.perf_counter() - start))
+
+    @seed.command('restore')
+    @click.argument('path')
+    def restore_command(path):
+        '''Replace the database contents with the snapshot at PATH.'''
+        start = time.perf_counter()
+        restore(path)
+        click.echo('restored %s in %.1fs' % (path, time.perf_counter() - start))
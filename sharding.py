@@ -0,0 +1,105 @@
+import contextlib
+import os
+
+import click
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+
+#----------------------------------------------------------------------------#
+# Shard routing.
+#----------------------------------------------------------------------------#
+
+# Every SQLALCHEMY_BINDS entry is a shard holding one region's catalog, with
+# its own engine and connection pool. None is the default shard, the
+# SQLALCHEMY_DATABASE_URI database. A request's tenant (its subdomain or
+# X-Tenant header, see TENANT_KEY) picks the shard through TENANT_SHARDS.
+# Outside requests the shard comes from the FYYUR_SHARD environment
+# variable, e.g. `FYYUR_SHARD=west flask matches rebuild`.
+
+def current_shard():
+    if has_app_context() and 'shard' in g:
+        return g.shard
+    return os.environ.get('FYYUR_SHARD') or None
+
+
+def get_engine(app, shard):
+    return get_state(app).db.get_engine(app, bind=shard)
+
+
+def engine():
+    # The current shard's engine, for code that needs raw connections
+    return get_engine(current_app._get_current_object(), current_shard())
+
+
+def shards(app):
+    return [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+@contextlib.contextmanager
+def use(shard):
+    # Routes the session of the current app context to `shard`, used by
+    # background workers to run a job on the shard it was queued from
+    missing = object()
+    previous = g.get('shard', missing)
+    g.shard = shard
+    try:
+        yield
+    finally:
+        if previous is missing:
+            g.pop('shard', None)
+        else:
+            g.shard = previous
+
+
+class ShardedSession(SignallingSession):
+    '''Session that sends every statement to the current shard's engine.'''
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = current_shard()
+        if shard is None:
+            return SignallingSession.get_bind(self, mapper, clause)
+        return get_engine(self.app, shard)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+
+def tenant():
+    if current_app.config.get('TENANT_KEY', 'subdomain') == 'header':
+        return request.headers.get('X-Tenant') or None
+    labels = request.host.split(':')[0].split('.')
+    return labels[0] if len(labels) > 2 else None
+
+
+def route_request():
+    g.shard = current_app.config.get('TENANT_SHARDS', {}).get(tenant(), current_app.config.get('TENANT_DEFAULT_SHARD'))
+
+
+def init_app(app):
+    known = set(shards(app))
+    targets = set(app.config.get('TENANT_SHARDS', {}).values()) | {app.config.get('TENANT_DEFAULT_SHARD')}
+    if not targets <= known:
+        raise ValueError('TENANT_SHARDS routes to unknown shards: %s' % ', '.join(map(str, targets - known)))
+
+    # Registered before every other before_request hook, so nothing touches
+    # the database before the request is routed
+    app.before_request_funcs.setdefault(None, []).insert(0, route_request)
+
+    @app.cli.group('shards')
+    def shards_group():
+        '''Inspect the shards and the tenants routed to them.'''
+
+    @shards_group.command('list')
+    def list_command():
+        '''List shards with their tenants and pool status.'''
+        tenants = app.config.get('TENANT_SHARDS', {})
+        for shard in shards(app):
+            shard_engine = get_engine(app, shard)
+            routed = sorted(name for name, target in tenants.items() if target == shard)
+            click.echo('%-10s %s\n           tenants: %s\n           pool: %s' % (
+                shard or 'default', repr(shard_engine.url), ', '.join(routed) or '-', shard_engine.pool.status()))
@@ -0,0 +1,319 @@
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import click
+from flask import current_app, g, request, send_file, session
+from sqlalchemy import event, inspect
+
+from models import db, Venue, Artist, Show
+import formatting
+import images
+import sharding
+
+logger = logging.getLogger(__name__)
+
+
+#----------------------------------------------------------------------------#
+# Static snapshots of the public pages.
+#----------------------------------------------------------------------------#
+
+# In publish mode (SNAPSHOTS_ENABLED) the home page, the venue and artist
+# listings and the detail pages are rendered to HTML files under
+# SNAPSHOT_DIR/<shard>/, and plain GETs of those pages are answered from the
+# files without touching the database. Anything a snapshot cannot answer
+# (query strings, JSON clients, pending flash messages, a locale or timezone
+# other than the defaults, a missing or stale file) falls through to the
+# dynamic view.
+ENDPOINTS = ('index', 'venues', 'artists', 'show_venue', 'show_artist')
+
+# Fields shown on the pages of the other side of a venue's or artist's shows
+LINKED_FIELDS = ('name', 'image_link', 'deleted_at')
+
+
+def venue_path(venue_id):
+    return '/venues/%d' % venue_id
+
+
+def artist_path(artist_id):
+    return '/artists/%d' % artist_id
+
+
+class SnapshotStore(object):
+    '''HTML files named after the page path, one directory per shard.'''
+
+    def __init__(self, root='snapshots'):
+        self.root = root
+
+    def file(self, shard, path):
+        return os.path.join(self.root, shard or 'default', (path.strip('/') or 'index') + '.html')
+
+    def write(self, shard, path, body):
+        # Written aside and renamed, readers never see a partial page
+        target = self.file(shard, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def remove(self, shard, path):
+        try:
+            os.unlink(self.file(shard, path))
+        except FileNotFoundError:
+            pass
+
+    def fresh(self, shard, path, max_age):
+        # The file's name if it exists and is younger than max_age seconds
+        target = self.file(shard, path)
+        try:
+            age = time.time() - os.stat(target).st_mtime
+        except OSError:
+            return None
+        return target if not max_age or age < max_age else None
+
+
+store = SnapshotStore()
+
+
+def render(app, shard, path):
+    '''Renders `path` through its dynamic view and stores or drops its snapshot.
+
+    Each page gets its own app context, nothing memoised on `g` for one page
+    (preferences, thumbnail urls) carries over to the next. Pages showing the
+    placeholder of an image that is still being fetched are not stored.
+    Returns the response status and the image links the page waits on.
+    '''
+    with app.app_context(), app.test_request_context(path, headers={'Accept': 'text/html'}), sharding.use(shard):
+        try:
+            response = app.make_response(app.view_functions[request.url_rule.endpoint](**request.view_args))
+            pending = g.get('pending_thumbnails', set())
+        finally:
+            db.session.remove()
+        if response.status_code == 200 and not pending:
+            store.write(shard, path, response.get_data())
+        else:
+            # Deleted venues and artists 404, their page goes with them. The
+            # dynamic view answers pages waiting on images until re-rendered.
+            store.remove(shard, path)
+        return response.status_code, pending
+
+
+def linked_paths(refs):
+    # (model, id) -> detail pages listing that venue or artist among their shows
+    paths = set()
+    venue_ids = [entity_id for model, entity_id in refs if model is Venue]
+    artist_ids = [entity_id for model, entity_id in refs if model is Artist]
+    if venue_ids:
+        paths.update(artist_path(artist_id) for (artist_id,) in
+                     db.session.query(Show.artist_id).filter(Show.venue_id.in_(venue_ids)).distinct())
+    if artist_ids:
+        paths.update(venue_path(venue_id) for (venue_id,) in
+                     db.session.query(Show.venue_id).filter(Show.artist_id.in_(artist_ids)).distinct())
+    db.session.remove()
+    return paths
+
+
+def all_paths():
+    paths = ['/', '/venues', '/artists']
+    paths += [venue_path(venue_id) for (venue_id,) in Venue.active().with_entities(Venue.id)]
+    paths += [artist_path(artist_id) for (artist_id,) in Artist.active().with_entities(Artist.id)]
+    db.session.remove()
+    return paths
+
+
+class SnapshotWorker(object):
+    '''Single background thread that re-renders the pages touched by writes.
+
+    Pages already queued for a shard are not queued twice, so a burst of
+    edits or of requests for a missing snapshot renders each page once.
+    Pages waiting on image fetches are queued again as the fetches end.
+    '''
+
+    def __init__(self, app=None):
+        self.app = app
+        self.queue = queue.Queue()
+        self._pending = set()
+        self._awaiting = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, paths, refs=(), shard=None):
+        with self._lock:
+            paths = {path for path in paths if (shard, path) not in self._pending}
+            if not paths and not refs:
+                return
+            self._pending.update((shard, path) for path in paths)
+            self.queue.put((shard, paths, set(refs)))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='snapshot-worker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            shard, paths, refs = self.queue.get()
+            try:
+                with self.app.app_context():
+                    if refs:
+                        with sharding.use(shard):
+                            paths |= linked_paths(refs)
+                    for path in sorted(paths):
+                        with self._lock:
+                            self._pending.discard((shard, path))
+                        try:
+                            status, waiting_on = render(self.app, shard, path)
+                            with self._lock:
+                                for url in waiting_on:
+                                    self._awaiting.setdefault(url, set()).add((shard, path))
+                        except Exception:
+                            # The stale file is dropped, the dynamic view answers until the next render
+                            store.remove(shard, path)
+                            logger.exception('snapshot of %s on shard %s failed', path, shard or 'default')
+            except Exception:
+                logger.exception('snapshot refresh on shard %s failed', shard or 'default')
+            finally:
+                with self._lock:
+                    self._pending.difference_update((shard, path) for path in paths)
+                self.queue.task_done()
+
+    def image_fetched(self, url):
+        # ImageFetcher listener. A fetch that ended before its page was
+        # recorded here leaves no snapshot, the next visit queues the page.
+        with self._lock:
+            waiting = self._awaiting.pop(url, ())
+        by_shard = {}
+        for shard, path in waiting:
+            by_shard.setdefault(shard, set()).add(path)
+        for shard, paths in by_shard.items():
+            self.submit(paths, shard=shard)
+
+
+worker = SnapshotWorker()
+
+
+#----------------------------------------------------------------------------#
+# Invalidation.
+#----------------------------------------------------------------------------#
+
+# Pages changed in a flush are collected on the session and re-rendered once
+# the transaction commits, like the entity cache and the rollups.
+
+def _changed(obj, fields):
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_pages(session, flush_context):
+    if worker.app is None:
+        return
+    paths = session.info.setdefault('snapshot_paths', set())
+    refs = session.info.setdefault('snapshot_refs', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Venue) and obj.id is not None:
+            paths.update(('/venues', venue_path(obj.id)))
+            if obj not in session.new and _changed(obj, LINKED_FIELDS):
+                refs.add((Venue, obj.id))
+        elif isinstance(obj, Artist) and obj.id is not None:
+            paths.update(('/artists', artist_path(obj.id)))
+            if obj not in session.new and _changed(obj, LINKED_FIELDS):
+                refs.add((Artist, obj.id))
+        elif isinstance(obj, Show):
+            # Both ends of the show, and the old ones when it was moved
+            state = inspect(obj)
+            paths.update(venue_path(int(value)) for value in state.attrs.venue_id.history.sum() if value is not None)
+            paths.update(artist_path(int(value)) for value in state.attrs.artist_id.history.sum() if value is not None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _submit_pages(session):
+    paths = session.info.pop('snapshot_paths', None)
+    refs = session.info.pop('snapshot_refs', None)
+    if (paths or refs) and worker.app is not None and worker.app.config.get('SNAPSHOTS_ENABLED'):
+        worker.submit(paths or (), refs or (), sharding.current_shard())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_pages(session):
+    session.info.pop('snapshot_paths', None)
+    session.info.pop('snapshot_refs', None)
+
+
+#----------------------------------------------------------------------------#
+# Serving.
+#----------------------------------------------------------------------------#
+
+def serve_snapshot():
+    if not current_app.config.get('SNAPSHOTS_ENABLED') or request.endpoint not in ENDPOINTS:
+        return None
+    if request.method != 'GET' or request.args or '_flashes' in session:
+        return None
+    if request.accept_mimetypes['application/json'] > request.accept_mimetypes['text/html']:
+        return None
+    # Show times are rendered in the default locale and timezone, visitors
+    # whose cookies or Accept-Language pick others get the dynamic page
+    config = current_app.config
+    if formatting.user_preferences() != (config.get('DEFAULT_LOCALE', 'en_US'), config.get('DEFAULT_TIMEZONE', 'UTC')):
+        return None
+    shard = sharding.current_shard()
+    # Detail pages split past from upcoming shows when rendered, so snapshots
+    # expire after SNAPSHOT_MAX_AGE. Missing and expired pages are rendered
+    # in the background and served dynamically meanwhile.
+    target = store.fresh(shard, request.path, current_app.config.get('SNAPSHOT_MAX_AGE'))
+    if target is None:
+        worker.submit([request.path], shard=shard)
+        return None
+    response = send_file(target, mimetype='text/html', conditional=True, cache_timeout=0)
+    response.headers['X-Snapshot'] = 'hit'
+    return response
+
+
+def init_app(app):
+    store.root = app.config.get('SNAPSHOT_DIR', 'snapshots')
+    worker.app = app
+    images.fetcher.listeners.append(worker.image_fetched)
+    # Runs after sharding.route_request, which is always first
+    app.before_request(serve_snapshot)
+
+    @app.cli.group('snapshots')
+    def snapshots():
+        '''Static snapshots of the public pages (publish mode).'''
+
+    @snapshots.command('publish')
+    def publish_command():
+        '''Render every public page of the current shard (FYYUR_SHARD).'''
+        shard = sharding.current_shard()
+        statuses = {}
+        waiting = []
+        for path in all_paths():
+            status, waiting_on = render(app, shard, path)
+            if waiting_on:
+                waiting.append(path)
+            else:
+                statuses[status] = statuses.get(status, 0) + 1
+        if waiting:
+            # Pages that showed placeholders, rendered again once the fetches are over
+            images.fetcher.queue.join()
+            for path in waiting:
+                status, waiting_on = render(app, shard, path)
+                statuses[status] = statuses.get(status, 0) + 1
+        click.echo('rendered %s' % ', '.join('%d %s' % (count, status) for status, count in sorted(statuses.items())))
+
+    @snapshots.command('clear')
+    def clear_command():
+        '''Delete the current shard's snapshots, pages are served dynamically until re-rendered.'''
+        root = os.path.join(store.root, sharding.current_shard() or 'default')
+        removed = 0
+        for directory, _, files in os.walk(root):
+            for name in files:
+                if name.endswith('.html'):
+                    os.unlink(os.path.join(directory, name))
+                    removed += 1
+        click.echo('removed %d snapshots' % removed)
@@ -2,3 +2,29 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+// Search-as-you-type: fill the search box datalist from /suggest
+document.querySelectorAll('input[data-suggest-types]').forEach(function (input) {
+  var list = document.getElementById(input.getAttribute('list'));
+  var timer = null;
+  input.addEventListener('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(function () {
+      var q = input.value.trim();
+      if (!q) {
+        list.innerHTML = '';
+        return;
+      }
+      fetch('/suggest?q=' + encodeURIComponent(q) + '&types=' + input.dataset.suggestTypes)
+        .then(function (response) { return response.json(); })
+        .then(function (data) {
+          list.innerHTML = '';
+          data.suggestions.forEach(function (suggestion) {
+            var option = document.createElement('option');
+            option.value = suggestion.name;
+            list.appendChild(option);
+          });
+        });
+    }, 80);
+  });
+});
@@ -0,0 +1,165 @@
+import bisect
+import threading
+
+from sqlalchemy import event, literal, union_all
+
+from models import db, Area, Venue, Artist
+import sharding
+
+
+#----------------------------------------------------------------------------#
+# In-memory prefix index for search suggestions.
+#----------------------------------------------------------------------------#
+
+KINDS = {Venue: 'venue', Artist: 'artist', Area: 'city'}
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+class SuggestionIndex(object):
+    '''Sorted array of (key, rank, kind, id, label) searched with bisect.
+
+    Every name is indexed once as a whole (rank 0) and once per later word
+    (rank 1), so "hop" finds "The Musical Hop" after names starting with
+    "hop". Lookups never touch the database.
+    '''
+
+    def __init__(self):
+        self._entries = []
+        self._by_entity = {}
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def _keys(self, label):
+        words = normalize(label).split(' ')
+        yield ' '.join(words), 0
+        for i in range(1, len(words)):
+            yield ' '.join(words[i:]), 1
+
+    def update(self, changes):
+        # changes: {(kind, id): label, or None to drop it}. The new array is
+        # built aside and swapped in, searches keep walking the one they took.
+        with self._lock:
+            entries = list(self._entries)
+            for (kind, entity_id), label in changes.items():
+                for entry in self._by_entity.pop((kind, entity_id), ()):
+                    i = bisect.bisect_left(entries, entry)
+                    if i < len(entries) and entries[i] == entry:
+                        del entries[i]
+                if label is not None:
+                    added = [(key, rank, kind, entity_id, label) for key, rank in self._keys(label)]
+                    for entry in added:
+                        bisect.insort(entries, entry)
+                    self._by_entity[(kind, entity_id)] = added
+            self._entries = entries
+
+    def add(self, kind, entity_id, label):
+        self.update({(kind, entity_id): label})
+
+    def remove(self, kind, entity_id):
+        self.update({(kind, entity_id): None})
+
+    def load(self, rows):
+        # Replaces the whole index, rows: (kind, id, label)
+        entries = []
+        by_entity = {}
+        for kind, entity_id, label in rows:
+            by_entity[(kind, entity_id)] = [(key, rank, kind, entity_id, label)
+                                            for key, rank in self._keys(label)]
+            entries.extend(by_entity[(kind, entity_id)])
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._by_entity = by_entity
+            self.loaded = True
+
+    def search(self, prefix, limit=10, kinds=None):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        # Read once, writers swap in a new list instead of changing this one
+        entries = self._entries
+        start = bisect.bisect_left(entries, (prefix,))
+        # Collect a little past `limit` so whole-name matches can be ranked
+        # first. Only entries of the requested kinds count towards the window.
+        candidates = []
+        seen = set()
+        for i in range(start, len(entries)):
+            key, rank, kind, entity_id, label = entries[i]
+            if not key.startswith(prefix) or len(candidates) >= limit * 8:
+                break
+            if (kinds and kind not in kinds) or (kind, entity_id) in seen:
+                continue
+            seen.add((kind, entity_id))
+            candidates.append((rank, label.lower(), kind, entity_id, label))
+        candidates.sort()
+        return [(kind, entity_id, label) for _, _, kind, entity_id, label in candidates[:limit]]
+
+
+# One index per shard
+indexes = {}
+_load_lock = threading.Lock()
+
+
+def ensure_loaded():
+    # The current shard's index, loaded on first use
+    shard = sharding.current_shard()
+    index = indexes.get(shard)
+    if index is not None and index.loaded:
+        return index
+    with _load_lock:
+        index = indexes.setdefault(shard, SuggestionIndex())
+        if index.loaded:
+            return index
+        # One projected query for every suggestible name
+        query = union_all(
+            db.select([literal('venue'), Venue.id, Venue.name]).where(Venue.deleted_at.is_(None)),
+            db.select([literal('artist'), Artist.id, Artist.name]).where(Artist.deleted_at.is_(None)),
+            db.select([literal('city'), Area.id, Area.city + ', ' + Area.state]),
+        )
+        index.load(db.session.execute(query))
+        return index
+
+
+def label_of(obj):
+    if isinstance(obj, Area):
+        return '%s, %s' % (obj.city, obj.state)
+    return obj.name
+
+
+#----------------------------------------------------------------------------#
+# Incremental refresh.
+#----------------------------------------------------------------------------#
+
+# Like entity_cache, changes are collected per flush and applied on commit
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault('suggest_pending', {})
+    for obj in list(session.new) + list(session.dirty):
+        kind = KINDS.get(type(obj))
+        if kind and obj.id is not None:
+            if getattr(obj, 'deleted_at', None) is None:
+                pending[(kind, obj.id)] = label_of(obj)
+            else:
+                pending[(kind, obj.id)] = None
+    for obj in session.deleted:
+        kind = KINDS.get(type(obj))
+        if kind and obj.id is not None:
+            pending[(kind, obj.id)] = None
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_committed(session):
+    pending = session.info.pop('suggest_pending', None)
+    index = indexes.get(sharding.current_shard())
+    if not pending or index is None or not index.loaded:
+        return
+    index.update(pending)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('suggest_pending', None)
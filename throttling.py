@@ -0,0 +1,159 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, render_template, request
+
+import sharding
+
+try:
+    import redis
+except ImportError:  # only needed for RATELIMIT_STORAGE_URL
+    redis = None
+
+
+#----------------------------------------------------------------------------#
+# Token bucket storage.
+#----------------------------------------------------------------------------#
+
+class MemoryStorage(object):
+    '''Per-process token buckets, the least recently used are dropped past max_keys.'''
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        # Returns (allowed, seconds until a token is available)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class RedisStorage(object):
+    '''Token buckets shared by every worker through Redis.'''
+
+    # Refill and take in one round trip, atomically on the server
+    script = '''
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+        local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+        tokens = math.min(tonumber(ARGV[2]), tokens + (tonumber(ARGV[3]) - updated) * tonumber(ARGV[1]))
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 't', tokens, 'u', ARGV[3])
+        redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2]) / tonumber(ARGV[1])) + 1)
+        return {allowed, tostring(tokens)}
+    '''
+
+    def __init__(self, url, prefix='fyyur:ratelimit:'):
+        if redis is None:
+            raise RuntimeError('RATELIMIT_STORAGE_URL needs the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(self.script)
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        allowed, tokens = self._take(keys=[self.prefix + key], args=[rate, burst, now])
+        tokens = float(tokens)
+        return bool(allowed), 0 if allowed else (1 - tokens) / rate
+
+
+#----------------------------------------------------------------------------#
+# Rate limiting and admission control.
+#----------------------------------------------------------------------------#
+
+storage = MemoryStorage()
+
+
+def client_key():
+    # RATELIMIT_TRUST_PROXY is the number of proxies in front of the app (True
+    # means one). Each appends the address it saw to X-Forwarded-For, so the
+    # client is the entry that many places from the right. Entries left of it
+    # come from the client and cannot be trusted.
+    hops = int(current_app.config.get('RATELIMIT_TRUST_PROXY') or 0)
+    if hops:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return request.remote_addr or 'unknown'
+
+
+def rejected(status, retry_after):
+    response = current_app.make_response((render_template('errors/%d.html' % status), status))
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+def rate_limit(rate, burst):
+    # Allows `rate` requests per second per client and endpoint, with bursts of up to `burst`
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if current_app.config.get('RATELIMIT_ENABLED', True):
+                key = '%s:%s' % (request.endpoint, client_key())
+                allowed, retry_after = storage.take(key, rate, burst)
+                if not allowed:
+                    return rejected(429, retry_after)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AdmissionGate(object):
+    '''Caps concurrent requests to the views it guards.
+
+    A request that cannot get a slot within ``wait`` seconds, or arrives
+    while every pooled database connection is checked out, gets a 503
+    straight away instead of queueing on the pool until it times out.
+    '''
+
+    def __init__(self, limit=15, wait=0.05, pool_limit=15):
+        self.configure(limit, wait, pool_limit)
+
+    def configure(self, limit, wait, pool_limit):
+        self.limit = limit
+        self.wait = wait
+        self.pool_limit = pool_limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def pool_saturated(self):
+        # Each shard has its own pool, this checks the request's
+        pool = sharding.engine().pool
+        return hasattr(pool, 'checkedout') and pool.checkedout() >= self.pool_limit
+
+    def __call__(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.pool_saturated() or not self._slots.acquire(timeout=self.wait):
+                return rejected(503, 1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self._slots.release()
+        return wrapper
+
+
+admission_gate = AdmissionGate()
+
+
+def init_app(app):
+    global storage
+    if app.config.get('RATELIMIT_STORAGE_URL'):
+        storage = RedisStorage(app.config['RATELIMIT_STORAGE_URL'])
+    admission_gate.configure(app.config.get('ADMISSION_MAX_CONCURRENT', 15),
+                             app.config.get('ADMISSION_WAIT', 0.05),
+                             app.config.get('ADMISSION_POOL_LIMIT', 15))
@@ -0,0 +1,111 @@
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+#----------------------------------------------------------------------------#
+# Request-scoped transactions.
+#----------------------------------------------------------------------------#
+
+def transactional(route_class):
+    '''Runs the view as one unit of work.
+
+    Views commit what they mean to keep. Whatever is still open when the view
+    returns or raises is rolled back right there, so the connection goes back
+    to the pool clean before the response is sent, and a failed statement
+    never leaves it in an aborted transaction. Every transaction the view
+    begins gets the statement timeout of its route class (STATEMENT_TIMEOUTS).
+    '''
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.statement_timeout = current_app.config.get('STATEMENT_TIMEOUTS', {}).get(route_class)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                db.session.rollback()
+        wrapper.route_class = route_class
+        return wrapper
+    return decorator
+
+
+@event.listens_for(db.session, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    # Straight on the DBAPI cursor: one round trip, not counted by query budgets
+    timeout = g.get('statement_timeout') if has_request_context() else None
+    if timeout and connection.dialect.name == 'postgresql':
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('SET LOCAL statement_timeout = %d' % timeout)
+        finally:
+            cursor.close()
+
+
+#----------------------------------------------------------------------------#
+# Long-held connection detection.
+#----------------------------------------------------------------------------#
+
+# id(connection record) -> [checked out at, thread id, endpoint, reported]
+_held = {}
+_held_lock = threading.Lock()
+hold_warning = None
+
+
+@event.listens_for(Pool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    endpoint = request.endpoint if has_request_context() else None
+    with _held_lock:
+        _held[id(connection_record)] = [time.monotonic(), threading.get_ident(), endpoint, False]
+
+
+@event.listens_for(Pool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    with _held_lock:
+        held = _held.pop(id(connection_record), None)
+    if held is None or hold_warning is None:
+        return
+    seconds = time.monotonic() - held[0]
+    if seconds > hold_warning:
+        logger.warning('connection held %.1fs by %s', seconds, held[2] or 'thread %d' % held[1])
+
+
+def _report_held(threshold):
+    # Logs every connection held past threshold once, with the holder's stack
+    now = time.monotonic()
+    frames = sys._current_frames()
+    with _held_lock:
+        stuck = [held for held in _held.values() if not held[3] and now - held[0] > threshold]
+        for held in stuck:
+            held[3] = True
+    for start, thread, endpoint, reported in stuck:
+        frame = frames.get(thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(thread gone)\n'
+        logger.error('connection checked out for %.1fs by %s, still held:\n%s',
+                     now - start, endpoint or 'thread %d' % thread, stack)
+
+
+def _watch(threshold):
+    while True:
+        time.sleep(max(threshold / 2, 0.5))
+        try:
+            _report_held(threshold)
+        except Exception:
+            logger.exception('connection watchdog failed')
+
+
+def init_app(app):
+    global hold_warning
+    hold_warning = app.config.get('CONNECTION_HOLD_WARNING')
+    if hold_warning:
+        threading.Thread(target=_watch, args=(hold_warning,), name='connection-watchdog', daemon=True).start()
@@ -0,0 +1,98 @@
+import datetime
+from collections import namedtuple
+
+from models import Venue, Artist
+
+
+#----------------------------------------------------------------------------#
+# View models.
+#----------------------------------------------------------------------------#
+
+# Pages are rendered from these namedtuples rather than from ORM instances or
+# dicts: they are built straight from column-projected query rows, take no
+# per-instance __dict__, and as_dict() turns them into the JSON responses.
+
+EntityLink = namedtuple('EntityLink', ('id', 'name'))
+AreaListing = namedtuple('AreaListing', ('city', 'state', 'venues'))
+
+ShowListing = namedtuple('ShowListing', (
+    'venue_id', 'venue_name', 'artist_id', 'artist_name', 'artist_image_link', 'start_time'))
+VenueShow = namedtuple('VenueShow', ('artist_id', 'artist_name', 'artist_image_link', 'start_time'))
+ArtistShow = namedtuple('ArtistShow', ('venue_id', 'venue_name', 'venue_image_link', 'start_time'))
+Recommendation = namedtuple('Recommendation', ('id', 'name', 'image_link', 'score'))
+
+SHOW_FIELDS = (
+    'past_shows', 'upcoming_shows', 'past_shows_count', 'upcoming_shows_count',
+    'history', 'more_history')
+VENUE_COLUMNS = (
+    'id', 'name', 'genres', 'address', 'city', 'state', 'phone', 'website', 'image_link',
+    'facebook_link', 'seeking_talent', 'seeking_description')
+ARTIST_COLUMNS = (
+    'id', 'name', 'genres', 'city', 'state', 'phone', 'website', 'image_link',
+    'facebook_link', 'seeking_venue', 'seeking_description')
+
+VenueDetail = namedtuple('VenueDetail', VENUE_COLUMNS + SHOW_FIELDS)
+ArtistDetail = namedtuple('ArtistDetail', ARTIST_COLUMNS + SHOW_FIELDS)
+
+
+def venue_columns():
+    return [getattr(Venue, column) for column in VENUE_COLUMNS]
+
+
+def artist_columns():
+    return [getattr(Artist, column) for column in ARTIST_COLUMNS]
+
+
+def group_areas(rows):
+    # rows: (area_id, city, state, venue_id, venue_name) ordered by area id and
+    # venue name. Returns the areas sorted by city and state.
+    areas = []
+    ref_area = None
+    for area_id, city, state, venue_id, venue_name in rows:
+        if area_id != ref_area:
+            areas.append(AreaListing(city, state, []))
+            ref_area = area_id
+        areas[-1].venues.append(EntityLink(venue_id, venue_name))
+    areas.sort(key=lambda area: (area.city, area.state))
+    return areas
+
+
+def split_shows(rows, entities, make_show, format_time, now=None):
+    # rows: (entity_id, start_time) of one venue's or artist's shows, entities:
+    # entity_cache summaries of the other side. Returns (past, upcoming).
+    now = now or datetime.datetime.today()
+    past, upcoming = [], []
+    for entity_id, start_time in rows:
+        entity = entities.get(entity_id)
+        if entity is None or entity.deleted:
+            continue
+        show = make_show(entity_id, entity.name, entity.image_link, format_time(start_time))
+        (past if start_time < now else upcoming).append(show)
+    return past, upcoming
+
+
+def detail(cls, row, past_shows, upcoming_shows, history, more_history):
+    return cls(*row, past_shows, upcoming_shows, len(past_shows), len(upcoming_shows),
+               history, more_history)
+
+
+def recommended(matches, entities):
+    # matches: (other id, score) rows from the Match table, best first
+    recommendations = []
+    for entity_id, score in matches:
+        entity = entities.get(entity_id)
+        if entity is not None and not entity.deleted:
+            recommendations.append(Recommendation(entity_id, entity.name, entity.image_link, round(score, 3)))
+    return recommendations
+
+
+def as_dict(value):
+    if hasattr(value, '_asdict'):
+        return {key: as_dict(item) for key, item in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [as_dict(item) for item in value]
+    if isinstance(value, dict):
+        return {key: as_dict(item) for key, item in value.items()}
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value